@@ -0,0 +1,278 @@
+"""
+Assembler throughput benchmarks
+
+Times the phases of Assembler.assemble separately on synthetic functions
+of 10 to 1,000,000 instructions and on the fib and metafib test assets:
+
+    preprocess  tokenizing the source and reading it into the Assembler
+    consts      evaluating the .consts section
+    operands    resolving symbolic operands and jump targets
+    relax       sizing EXTENDED_ARG prefixes and laying out the bytecode
+    lnotab      encoding the line number table
+    total       a whole assemble() with the code cache cleared
+
+Each timing is the best of --repeat runs. Results can be written as JSON
+with --output and checked against an earlier run with --baseline, in
+which case the exit status is 1 if anything got slower than the
+tolerance allows.
+
+    python benchmarks/bench_assemble.py --output baseline.json
+    python benchmarks/bench_assemble.py --baseline baseline.json
+
+A bare --baseline compares against benchmarks/baseline.json, the stored
+run to gate changes on. Rewrite it with --output when the assembler
+gets faster on purpose.
+"""
+import argparse
+import ast
+import json
+import os
+import platform
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from cpython_assembly import asm  # noqa: E402
+from cpython_assembly.__version__ import __version__  # noqa: E402
+
+ASSETS = os.path.join(os.path.dirname(HERE), 'tests', 'assets')
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+SIZES = (10, 100, 1000, 10000, 100000, 1000000)
+
+PHASES = ('preprocess', 'consts', 'operands', 'relax', 'lnotab', 'total')
+
+# Baseline timings shorter than this are too noisy to compare
+MIN_COMPARE_TIME = 0.001
+
+
+def synthetic_source(count):
+    """
+    Source for a function of count instructions, one per line.
+
+    The body is a run of additions of constants to a local, with a
+    label every 50 instructions and jumps both back to the start and
+    forward to the end, so that large functions need EXTENDED_ARG on
+    their jumps.
+    """
+    nconsts = max(1, min(count // 10, 1000))
+    lines = ['.stacksize 4', '.locals x', '.consts']
+    lines.extend('  c{0} = {0}'.format(idx) for idx in range(nconsts))
+    lines.append('.code')
+    lines.append('start:')
+    body = count - 2
+    idx = 0
+    while idx < body:
+        if idx % 50 == 0:
+            lines.append('l{0}:'.format(idx))
+        step = idx % 8
+        if step == 0:
+            line = 'LOAD_FAST x'
+        elif step == 1:
+            line = 'LOAD_CONST c{0}'.format(idx % nconsts)
+        elif step == 2:
+            line = 'BINARY_ADD'
+        elif step == 3:
+            line = 'STORE_FAST x'
+        elif step == 4:
+            line = 'LOAD_FAST x'
+        elif step == 5:
+            line = 'POP_JUMP_IF_FALSE start'
+        elif step == 6:
+            line = 'JUMP_FORWARD end'
+        else:
+            line = 'NOP'
+        lines.append(line)
+        idx += 1
+    lines.append('end:')
+    lines.append('LOAD_FAST x')
+    lines.append('RETURN_VALUE')
+    return '\n'.join(lines) + '\n'
+
+
+def asset_sources(filename):
+    """
+    Yield (name, source) for each asm function in a test asset, read
+    with ast so the module isn't imported (and assembled). The
+    parameters of the function are added as a params directive.
+    """
+    with open(os.path.join(ASSETS, filename)) as fp:
+        tree = ast.parse(fp.read())
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            doc = ast.get_docstring(node, clean=False) or ''
+            if ':::asm' in doc:
+                params = ', '.join(arg.arg for arg in node.args.args)
+                source = doc.split(':::asm')[1]
+                if params:
+                    source = '.params {0}\n{1}'.format(params, source)
+                yield node.name, source
+
+
+def cases(sizes):
+    for size in sizes:
+        yield 'synthetic-{0}'.format(size), synthetic_source(size)
+    for filename in ('metafib.py', 'longbad.py'):
+        for name, source in asset_sources(filename):
+            yield name, source
+
+
+# metafib takes the code of fib_inner as args[0]
+_ARGS = (compile('', '<bench>', 'exec'),)
+
+
+def _prepare(machine):
+    machine.assemble_stacksize()
+    machine.assemble_flags()
+    machine.assemble_params()
+    machine.assemble_locals()
+    machine.assemble_names()
+    machine.assemble_freevars()
+    machine.assemble_cellvars()
+
+
+def run_phases(source):
+    """
+    Time each phase once on a fresh Assembler, returning a dict of
+    phase to seconds and the number of instructions
+    """
+    timer = time.perf_counter
+    times = {}
+
+    asm._parse_const.cache_clear()
+    start = timer()
+    machine = asm.Assembler(source, args=_ARGS)
+    times['preprocess'] = timer() - start
+
+    start = timer()
+    machine.assemble_consts()
+    times['consts'] = timer() - start
+
+    _prepare(machine)
+    start = timer()
+    machine._fix_arguments()
+    times['operands'] = timer() - start
+    count = len(machine.bytecode) // 2
+
+    start = timer()
+    machine._relax_arguments()
+    times['relax'] = timer() - start
+
+    start = timer()
+    machine.assemble_lnotab()
+    times['lnotab'] = timer() - start
+
+    asm.CODE_CACHE.clear()
+    asm._parse_const.cache_clear()
+    start = timer()
+    asm.Assembler(source, args=_ARGS).assemble()
+    times['total'] = timer() - start
+    asm.CODE_CACHE.clear()
+
+    return times, count
+
+
+def run(sizes=SIZES, repeat=3, out=sys.stdout):
+    """
+    Run every case, keeping the best time of each phase
+    """
+    results = {}
+    for name, source in cases(sizes):
+        best = None
+        for _ in range(repeat):
+            times, count = run_phases(source)
+            if best is None:
+                best = times
+            else:
+                best = {
+                    phase: min(best[phase], times[phase]) for phase in PHASES
+                }
+        results[name] = {'instructions': count, 'phases': best}
+        if out is not None:
+            _report(out, name, count, best)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'cpython_assembly': __version__,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def _report(out, name, count, times):
+    cells = ' '.join(
+        '{0}={1:.6f}'.format(phase, times[phase]) for phase in PHASES
+    )
+    print('{0:<20} {1:>8} {2}'.format(name, count, cells), file=out)
+
+
+def compare(current, baseline, tolerance, out=sys.stdout):
+    """
+    Compare two runs, returning a list of (case, phase, ratio) for the
+    phases that are slower than the baseline by more than tolerance
+    """
+    regressions = []
+    for name, result in sorted(current['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        for phase in PHASES:
+            before = base['phases'].get(phase)
+            after = result['phases'][phase]
+            if before is None or before < MIN_COMPARE_TIME:
+                continue
+            ratio = after / before
+            flag = ''
+            if ratio > 1 + tolerance:
+                regressions.append((name, phase, ratio))
+                flag = '  SLOWER'
+            if out is not None:
+                print('{0:<20} {1:<10} {2:.6f} -> {3:.6f} ({4:.2f}x){5}'.format(
+                    name, phase, before, after, ratio, flag
+                ), file=out)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the phases of Assembler.assemble'
+    )
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=list(SIZES),
+        help='instruction counts of the synthetic functions'
+    )
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='runs per case, the best is kept'
+    )
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    parser.add_argument(
+        '-b', '--baseline', nargs='?', const=BASELINE,
+        help='JSON results to compare to (default: benchmarks/baseline.json)'
+    )
+    parser.add_argument(
+        '-t', '--tolerance', type=float, default=0.2,
+        help='allowed slowdown against the baseline (default 0.2 = 20%%)'
+    )
+    args = parser.parse_args(argv)
+
+    current = run(args.sizes, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(current, fp, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(current, baseline, args.tolerance)
+        if regressions:
+            print('{0} phase(s) slower than the baseline'.format(
+                len(regressions)
+            ), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
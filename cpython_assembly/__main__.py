@@ -0,0 +1,84 @@
+"""
+Command line interface, ``python -m cpython_assembly``
+"""
+import argparse
+import os
+import sys
+
+from cpython_assembly import build, disassemble
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m cpython_assembly')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    build_parser = commands.add_parser(
+        'build',
+        help='write .pyc files with the asm functions already assembled'
+    )
+    build_parser.add_argument(
+        'paths', nargs='+', help='python files or directories to build'
+    )
+    build_parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='number of worker processes (default: one per CPU)'
+    )
+    build_parser.add_argument(
+        '-f', '--force', action='store_true',
+        help='rebuild modules even if they are up to date'
+    )
+
+    dis_parser = commands.add_parser(
+        'dis',
+        help='write asm listings of every function in packages or modules'
+    )
+    dis_parser.add_argument(
+        'paths', nargs='+',
+        help='python files, directories or module names to disassemble'
+    )
+    dis_parser.add_argument(
+        '-o', '--output', default='asm',
+        help='directory for the listings and index (default: asm)'
+    )
+    dis_parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='number of worker processes (default: one per CPU)'
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == 'dis':
+        return _dis(args)
+    return _build(args)
+
+
+def _build(args):
+    status = 0
+    for path, result in build.build(args.paths, args.jobs, args.force):
+        if isinstance(result, Exception):
+            print('{0}: {1!r}'.format(path, result), file=sys.stderr)
+            status = 1
+        elif result is None:
+            print('{0}: up to date'.format(path))
+        else:
+            print('{0}: {1} functions prebuilt'.format(path, result))
+    return status
+
+
+def _dis(args):
+    status = 0
+    results = disassemble.disassemble(args.paths, args.output, args.jobs)
+    for path, result in results:
+        if isinstance(result, Exception):
+            print('{0}: {1!r}'.format(path, result), file=sys.stderr)
+            status = 1
+        else:
+            print('{0}: {1} code objects'.format(path, len(result)))
+    print('index: {0}'.format(
+        os.path.join(args.output, disassemble.INDEX_NAME)
+    ))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
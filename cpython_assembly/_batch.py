@@ -0,0 +1,88 @@
+"""
+Helpers shared by the commands working on whole packages: finding the
+python files and their module names, walking their code and running a
+job for each in a process pool
+"""
+from concurrent.futures import ProcessPoolExecutor
+import os
+import types
+
+from cpython_assembly.asm import CO_FLAGS
+
+
+def python_files(paths):
+    """
+    Yield the python files under the given files and directories
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+                for name in sorted(files):
+                    if name.endswith('.py'):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def module_name(path):
+    """
+    Full dotted name of the module at path, going up through the
+    directories with an ``__init__.py``. Returns the directory above
+    the top level package along with the name.
+    """
+    root, name = os.path.split(os.path.splitext(os.path.abspath(path))[0])
+    parts = [] if name == '__init__' else [name]
+    while os.path.isfile(os.path.join(root, '__init__.py')):
+        root, package = os.path.split(root)
+        parts.insert(0, package)
+    return root, '.'.join(parts)
+
+
+def walk_code(co, qualname='<module>'):
+    """
+    Yield ``(qualname, code)`` for a code object and all the code
+    objects nested in its constants
+    """
+    yield qualname, co
+    for const in co.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from walk_code(const, nested_qualname(co, qualname, const))
+
+
+def nested_qualname(co, qualname, const):
+    """
+    Qualname of the code object const, nested in co named qualname
+    """
+    if co.co_name == '<module>':
+        prefix = ''
+    elif co.co_flags & CO_FLAGS['OPTIMIZED']:
+        prefix = qualname + '.<locals>.'
+    else:
+        prefix = qualname + '.'
+    return prefix + const.co_name
+
+
+def map_safely(func, jobs, max_workers=None):
+    """
+    Call func with the arguments of each job, in a process pool if
+    there is more than one job and max_workers isn't 1. Returns the
+    results in order, with the exception raised by a call in place of
+    its result.
+    """
+    if len(jobs) > 1 and max_workers != 1:
+        with ProcessPoolExecutor(max_workers) as executor:
+            return list(executor.map(
+                _call_safely, [func] * len(jobs), *zip(*jobs)
+            ))
+    return [_call_safely(func, *job) for job in jobs]
+
+
+def _call_safely(func, *args):
+    """
+    Process pool worker, returning any exception instead of raising
+    """
+    try:
+        return func(*args)
+    except Exception as e:
+        return e
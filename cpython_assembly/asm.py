@@ -3,11 +3,33 @@ Let's do this!
 
 """
 from dis import (
-    opmap, HAVE_ARGUMENT,
+    opmap, opname, HAVE_ARGUMENT,
     hasjrel, hasjabs, haslocal, hasname, hasconst, hasfree,
-    get_instructions
+    stack_effect
 )
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from importlib.util import MAGIC_NUMBER
+from itertools import accumulate
+import ast
+import builtins
+import hashlib
+import io
+import json
+import logging
+import marshal
+import operator
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
 import types
+import weakref
+
+from cpython_assembly.__version__ import __version__
 
 CO_FLAGS = {
     'OPTIMIZED': 0x1,
@@ -22,38 +44,247 @@ CO_FLAGS = {
     'ASYNC_GENERATOR': 0x200
 }
 
+# Kinds of symbolic operand, and the kind taken by each opcode
+_ARG_KINDS = range(7)
+(
+    _ARG_NONE, _ARG_JABS, _ARG_JREL, _ARG_LOCAL, _ARG_NAME, _ARG_CONST,
+    _ARG_FREE
+) = _ARG_KINDS
+
+
+def _opcode_kinds():
+    """
+    Build the 256 entry opcode -> operand kind table. Where an opcode
+    is in more than one of the dis lists, the earlier kind wins.
+    """
+    kinds = bytearray(256)
+    for kind, ops in reversed((
+        (_ARG_JABS, hasjabs),
+        (_ARG_JREL, hasjrel),
+        (_ARG_LOCAL, haslocal),
+        (_ARG_NAME, hasname),
+        (_ARG_CONST, hasconst),
+        (_ARG_FREE, hasfree)
+    )):
+        for op in ops:
+            kinds[op] = kind
+    return bytes(kinds)
+
+
+_OPCODE_KIND = _opcode_kinds()
+
+# Jumps whose stack effect depends on whether the jump is taken,
+# as (fall through effect, jump effect). The exception handler of a
+# SETUP_* block is entered with 6 values pushed over the block level
+_BRANCH_EFFECTS = {
+    opmap['FOR_ITER']: (1, -1),
+    opmap['JUMP_IF_TRUE_OR_POP']: (-1, 0),
+    opmap['JUMP_IF_FALSE_OR_POP']: (-1, 0),
+    opmap['SETUP_EXCEPT']: (0, 6),
+    opmap['SETUP_FINALLY']: (0, 6),
+    opmap['SETUP_WITH']: (1, 6),
+    opmap['SETUP_ASYNC_WITH']: (0, 5),
+}
+_JUMP_NAMES = frozenset(opname[op] for op in hasjabs + hasjrel)
+_NO_STACK_EFFECT = frozenset((opmap['NOP'], opmap['EXTENDED_ARG']))
+_UNCONDITIONAL_JUMPS = frozenset(
+    (opmap['JUMP_ABSOLUTE'], opmap['JUMP_FORWARD'])
+)
+_NO_FALLTHROUGH = frozenset(opmap[name] for name in (
+    'JUMP_ABSOLUTE', 'JUMP_FORWARD', 'CONTINUE_LOOP', 'BREAK_LOOP',
+    'RETURN_VALUE', 'RAISE_VARARGS'
+))
+
+# Instructions whose target is also reached other than from the
+# instruction itself: by a break, an exception or leaving a finally
+# block, including through END_FINALLY on a continue
+_IMPLICIT_TARGETS = frozenset(opmap[name] for name in (
+    'SETUP_LOOP', 'SETUP_EXCEPT', 'SETUP_FINALLY', 'SETUP_WITH',
+    'SETUP_ASYNC_WITH', 'CONTINUE_LOOP'
+))
+
+# Operations that can be folded when their operands are constants
+_UNARY_FOLDS = {
+    opmap['UNARY_POSITIVE']: operator.pos,
+    opmap['UNARY_NEGATIVE']: operator.neg,
+    opmap['UNARY_INVERT']: operator.invert,
+}
+_BINARY_FOLDS = {
+    opmap['BINARY_POWER']: operator.pow,
+    opmap['BINARY_MULTIPLY']: operator.mul,
+    opmap['BINARY_MODULO']: operator.mod,
+    opmap['BINARY_ADD']: operator.add,
+    opmap['BINARY_SUBTRACT']: operator.sub,
+    opmap['BINARY_SUBSCR']: operator.getitem,
+    opmap['BINARY_FLOOR_DIVIDE']: operator.floordiv,
+    opmap['BINARY_TRUE_DIVIDE']: operator.truediv,
+    opmap['BINARY_LSHIFT']: operator.lshift,
+    opmap['BINARY_RSHIFT']: operator.rshift,
+    opmap['BINARY_AND']: operator.and_,
+    opmap['BINARY_XOR']: operator.xor,
+    opmap['BINARY_OR']: operator.or_,
+}
+# COMPARE_OP arguments that can be folded, by index in dis.cmp_op
+_COMPARE_FOLDS = (
+    operator.lt, operator.le, operator.eq, operator.ne, operator.gt,
+    operator.ge, lambda a, b: a in b, lambda a, b: a not in b,
+    operator.is_, operator.is_not
+)
+_CONDITIONAL_JUMPS = {
+    opmap['POP_JUMP_IF_FALSE']: False,
+    opmap['POP_JUMP_IF_TRUE']: True,
+}
+_INVERTED_JUMPS = {
+    opmap['POP_JUMP_IF_FALSE']: opmap['POP_JUMP_IF_TRUE'],
+    opmap['POP_JUMP_IF_TRUE']: opmap['POP_JUMP_IF_FALSE'],
+}
+# Blocks run less often than this fraction of calls are moved out of
+# the way by the block layout
+_COLD_FRACTION = 0.01
+_FOLDABLE_TYPES = (
+    int, float, complex, bool, str, bytes, type(None), type(Ellipsis)
+)
+_MAX_FOLD_SIZE = 20
+_MAX_FOLD_INT_BITS = 128
+
+# Look up (and store) assembled code objects in __pycache__
+# next to the module defining the function
+DISK_CACHE = True
+_ASSEMBLER_DIGEST = None
+
+# Last constant of the code of functions prebuilt by cpython_assembly.build,
+# which the decorator passes through as they are already assembled
+PREBUILT_MARKER = '__cpython_assembly_prebuilt__'
 
-def asm(*args):
+
+def asm(*args, **options):
     """
     Decorator to assemble a function from a docstring in my imaginary asm
     format for python bytecode
+
+    Keyword options are passed on to the Assembler, for example
+    ``@asm(optimize=1)``, except for ``lazy=True`` which puts off
+    assembly until the function is first called
     """
-    if len(args) == 1 and callable(args[0]):
+    if len(args) == 1 and callable(args[0]) and not options:
         return _asm(args[0], ())
 
     else:
         def decor(f):
-            return _asm(f, *args)
+            return _asm(f, *args, **options)
 
         return decor
 
 
-def _asm(f, *args):
+def _asm(f, *args, lazy=False, **options):
     """
     Interior decorator 
+
+    A function without asm source in its docstring must have been
+    prebuilt by cpython_assembly.build, and is already assembled
+    """
+    if ':::asm' not in (f.__doc__ or ''):
+        if f.__code__.co_consts[-1:] != (PREBUILT_MARKER,):
+            raise ValueError(
+                '{0} has no :::asm source in its docstring'.format(
+                    f.__qualname__
+                )
+            )
+        if f.__code__.co_freevars:
+            return f.__code__
+        return f
+
+    if lazy:
+        return _lazy_function(f, args, options)
+
+    return _make_function(f, _assemble_function(f, args, options))
+
+
+def _make_function(f, co_out):
+    """
+    The function for assembled code, with the globals, name and
+    defaults of f. Code with free variables is returned as is.
+    """
+    # feel kinda iffy about this
+    if co_out.co_freevars:
+        return co_out
+
+    result = types.FunctionType(
+        code=co_out,
+        globals=f.__globals__,
+        argdefs=f.__defaults__,
+        name=f.__code__.co_name,
+    ) 
+    result.__kwdefaults__ = f.__kwdefaults__
+    result.__doc__ = co_out.co_consts[0]
+    result.__qualname__ = f.__qualname__
+    return result
+
+
+def _assemble_function(f, args, options):
+    """
+    Assemble the code object for a function from its docstring
     """
     doc, source = f.__doc__.split(':::asm')
-    co_in = f.__code__
 
+    cache = _cache_entry(f, source, doc, args, options)
+    co_gen = None
+    if cache is not None:
+        co_gen = _cache_load(*cache)
+
+    if co_gen is None:
+        co_gen, machine = _assemble_source(
+            source, doc, f.__code__, args, options, STATS_HOOK is not None,
+            f.__globals__
+        )
+        if cache is not None:
+            _cache_store(*cache, co_gen)
+        stats = machine.stats
+    else:
+        machine = None
+        stats = AssemblyStats(cached='disk')
+    _report_stats(stats, f)
+
+    co_out = _function_code(co_gen, f.__code__)
+    if machine is not None and machine.bound:
+        _register_bound(f, co_out, machine.bound)
+    return co_out
+
+
+def _assemble_source(source, doc, co_in, args, options, stats=False,
+                     namespace=None):
+    """
+    Run the assembler over the asm part of a docstring, returning the
+    code and the Assembler
+    """
     machine = Assembler(
         source,
         doc=doc,
         code=co_in,
-        args=args
+        args=args,
+        stats=stats,
+        namespace=namespace,
+        **options
     )
-    co_gen = machine.assemble()
+    return machine.assemble(), machine
+
+
+def _assemble_marshalled(data, stats=False):
+    """
+    Process pool worker: assemble from the marshalled arguments of
+    _assemble_source and return the marshalled code object along
+    with the stats
+    """
+    co_gen, machine = _assemble_source(*marshal.loads(data), stats=stats)
+    return marshal.dumps(co_gen), machine.stats
 
-    co_out = types.CodeType(
+
+def _function_code(co_gen, co_in):
+    """
+    Give assembled code the signature, name and filename of the
+    original function
+    """
+    return types.CodeType(
         co_in.co_argcount,
         co_in.co_kwonlyargcount,
         co_gen.co_nlocals,
@@ -71,48 +302,708 @@ def _asm(f, *args):
         co_gen.co_cellvars
     )
 
-    # feel kinda iffy about this
-    if co_gen.co_freevars:
-        return co_out
 
+def _lazy_stub(*args, _asm_lazy, **kwargs):
+    """
+    Code for a function that has not been assembled yet. It only uses
+    its own arguments, so it runs with the globals of any module.
+    """
+    return _asm_lazy(args, kwargs)
+
+
+def _lazy_function(f, args, options):
+    """
+    Build a function that assembles itself on the first call, and
+    register it as pending for assemble_module
+    """
+    doc = f.__doc__.split(':::asm')[0]
     result = types.FunctionType(
-        code=co_out,
+        code=_lazy_stub.__code__,
         globals=f.__globals__,
-        argdefs=f.__defaults__,
-        name=co_in.co_name,
-    ) 
+        name=f.__name__,
+    )
+    lazy = _LazyAssembly(result, f, args, options)
+    result.__kwdefaults__ = {'_asm_lazy': lazy}
     result.__doc__ = doc
+    result.__qualname__ = f.__qualname__
+    result.__module__ = f.__module__
+    with _PENDING_LOCK:
+        _PENDING.setdefault(f.__module__, weakref.WeakSet()).add(lazy)
     return result
 
 
-def preprocess(source):
+class _LazyAssembly:
+    """
+    Assembles a lazy function on its first call and swaps the real code
+    and defaults into it, so that later calls go straight to the
+    assembled code. Only one thread assembles, others wait for it.
+    """
+    def __init__(self, func, f, args, options):
+        self.func = func
+        self.f = f
+        self.args = args
+        self.options = options
+        self.lock = threading.Lock()
+        self.done = False
+
+    def __call__(self, args, kwargs):
+        if not self.done:
+            with self.lock:
+                if not self.done:
+                    self.install(
+                        _assemble_function(self.f, self.args, self.options)
+                    )
+        return self.func(*args, **kwargs)
+
+    def install(self, co_out):
+        """
+        Swap the assembled code into the function. Callers must hold
+        the lock. The defaults go in before the code, so that other
+        threads never run it with the defaults of the stub, which
+        ignores them and still finds ``_asm_lazy``. Once the code is in,
+        the original kwdefaults are put back as they were, a stub that
+        is mid-call has its ``_asm_lazy`` already.
+        """
+        if co_out.co_freevars:
+            raise ValueError(
+                'lazy assembly is not supported for code with free variables'
+            )
+        kwdefaults = self.f.__kwdefaults__
+        self.func.__defaults__ = self.f.__defaults__
+        self.func.__kwdefaults__ = dict(kwdefaults or (), _asm_lazy=self)
+        self.func.__code__ = co_out
+        self.func.__kwdefaults__ = kwdefaults
+        self.done = True
+        self.f = None
+
+
+# Lazy functions not yet assembled, by module name
+_PENDING = {}
+_PENDING_LOCK = threading.Lock()
+
+
+def assemble_module(module, max_workers=None):
     """
-    Remove comments, dedent, split into lines and sections, record line
-    numbers with each line for the code section
+    Assemble every pending lazy (``@asm(lazy=True)``) function of a
+    module, given as a module object or name, and return how many were
+    assembled.
 
-    allow first line of section to be after the section header,
-    for example ``.stacksize 4``
+    Functions found in the disk cache are loaded directly. The rest are
+    assembled in parallel in a process pool, with the inputs and the
+    code objects sent across as marshal data. Functions whose decorator
+    arguments can't be marshalled are assembled in this process.
     """
-    lines = [line.split(';')[0].strip() for line in source.splitlines()]
-    sections = {'unknown': []}
-    current_section = 'unknown'
-    for lno, line in enumerate(lines):
+    name = getattr(module, '__name__', module)
+    with _PENDING_LOCK:
+        pending = list(_PENDING.pop(name, ()))
+
+    jobs = []
+    assembled = 0
+    for lazy in pending:
+        with lazy.lock:
+            if lazy.done:
+                continue
+            assembled += 1
+            f = lazy.f
+            doc, source = f.__doc__.split(':::asm')
+            cache = _cache_entry(f, source, doc, lazy.args, lazy.options)
+            co_gen = None
+            if cache is not None:
+                co_gen = _cache_load(*cache)
+            if co_gen is not None:
+                _report_stats(AssemblyStats(cached='disk'), f)
+                lazy.install(_function_code(co_gen, f.__code__))
+                continue
+            # bound globals have to be looked up in this process
+            data = None
+            if not _binds_globals(source, lazy.options):
+                try:
+                    data = marshal.dumps(
+                        (source, doc, f.__code__, lazy.args, lazy.options)
+                    )
+                except ValueError:
+                    pass
+            if data is None:
+                lazy.install(
+                    _assemble_function(f, lazy.args, lazy.options)
+                )
+                continue
+        jobs.append((lazy, cache, data))
+
+    collect = STATS_HOOK is not None
+    if len(jobs) > 1 and max_workers != 1:
+        with ProcessPoolExecutor(max_workers) as executor:
+            results = list(executor.map(
+                _assemble_marshalled,
+                [data for _, _, data in jobs],
+                [collect] * len(jobs)
+            ))
+    else:
+        results = [
+            _assemble_marshalled(data, collect) for _, _, data in jobs
+        ]
+
+    for (lazy, cache, _), (result, stats) in zip(jobs, results):
+        co_gen = marshal.loads(result)
+        with lazy.lock:
+            if lazy.done:
+                continue
+            if cache is not None:
+                _cache_store(*cache, co_gen)
+            _report_stats(stats, lazy.f)
+            lazy.install(_function_code(co_gen, lazy.f.__code__))
+
+    return assembled
+
+
+_BIND_DIRECTIVE = re.compile(r'^\s*\.bind\b', re.MULTILINE)
+
+
+def _load_layout_profile(profile):
+    """
+    Line counts for the layout_profile option, from a dict or the path
+    of a JSON file written by Profile.dump
+    """
+    if isinstance(profile, str):
+        with open(profile) as fp:
+            profile = json.load(fp)
+    return {int(line): int(count) for line, count in profile.items()}
+
+
+def _binds_globals(source, options):
+    return bool(options.get('bind_globals')) or bool(
+        _BIND_DIRECTIVE.search(source)
+    )
+
+
+# Globals bound into assembled code, by id of the code object:
+# (module name, function qualname, {name: bound value}). Code objects
+# compare by value, so equal code from one factory can't share a key.
+# Entries are dropped when their code goes away.
+_BOUND = {}
+_MISSING = object()
+
+
+def _register_bound(f, co_out, bound):
+    key = id(co_out)
+    _BOUND[key] = (f.__module__, f.__qualname__, bound)
+    weakref.finalize(co_out, _BOUND.pop, key, None)
+
+
+def _has_bound_globals(code):
+    """
+    Check whether code holds globals bound at assembly time
+    """
+    return id(code) in _BOUND
+
+
+def check_bound_globals(module):
+    """
+    Raise RuntimeError if any global bound into a function of the
+    module (given as a module object or name) by ``.bind`` or
+    ``bind_globals`` has been rebound since, or a bound builtin has
+    been shadowed by a global
+    """
+    name = getattr(module, '__name__', module)
+    namespace = vars(sys.modules[name])
+    rebound = []
+    for module_name, qualname, bound in list(_BOUND.values()):
+        if module_name != name:
+            continue
+        for global_name, value in bound.items():
+            current = namespace.get(
+                global_name, getattr(builtins, global_name, _MISSING)
+            )
+            if current is not value:
+                rebound.append('{0}.{1}: {2}'.format(
+                    name, qualname, global_name
+                ))
+    if rebound:
+        raise RuntimeError(
+            'bound globals have been rebound: {0}'.format(', '.join(rebound))
+        )
+
+
+# Called with the AssemblyStats of every function assembled by the
+# decorator, see set_stats_hook
+STATS_HOOK = None
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def set_stats_hook(hook):
+    """
+    Set a callable to be passed the AssemblyStats of each function
+    assembled through the asm decorator (or None to stop), and return
+    the previous one. log_stats can be used to send them to the
+    ``cpython_assembly.asm`` logger.
+
+    Collecting the stats traces allocations with tracemalloc, so
+    assembly is noticeably slower while a hook is set.
+    """
+    global STATS_HOOK
+    previous = STATS_HOOK
+    STATS_HOOK = hook
+    return previous
+
+
+def log_stats(stats):
+    """
+    Stats hook logging each function at INFO level
+    """
+    _LOGGER.info('%s', stats)
+
+
+def _report_stats(stats, f):
+    hook = STATS_HOOK
+    if hook is not None and stats is not None:
+        stats.name = '{0}.{1}'.format(f.__module__, f.__qualname__)
+        hook(stats)
+
+
+PhaseStats = namedtuple('PhaseStats', 'seconds peak_memory')
+
+
+class AssemblyStats:
+    """
+    What assembling one function took. phases maps each step of
+    Assembler.assemble, in order, to its PhaseStats: wall time in
+    seconds and the peak of memory allocated during the step in bytes
+    (None if it couldn't be measured, as when tracemalloc was already
+    tracing before python 3.9).
+
+    instructions doesn't count the EXTENDED_ARG prefixes, which are
+    counted by extended_args. For code found in a cache, cached is
+    'memory' or 'disk' and the rest is mostly left empty.
+    """
+    def __init__(self, cached=None):
+        self.name = None
+        self.cached = cached
+        self.phases = OrderedDict()
+        self.instructions = None
+        self.extended_args = None
+        self.lnotab_size = None
+
+    @property
+    def seconds(self):
+        return sum(phase.seconds for phase in self.phases.values())
+
+    @property
+    def peak_memory(self):
+        peaks = [
+            phase.peak_memory for phase in self.phases.values()
+            if phase.peak_memory is not None
+        ]
+        return max(peaks, default=None)
+
+    def __repr__(self):
+        if self.cached:
+            return '<AssemblyStats {0}: {1} cache>'.format(
+                self.name, self.cached
+            )
+        return (
+            '<AssemblyStats {0}: {1:.6f}s, peak {2} bytes, {3} instructions,'
+            ' {4} EXTENDED_ARG, lnotab {5} bytes>'.format(
+                self.name, self.seconds, self.peak_memory, self.instructions,
+                self.extended_args, self.lnotab_size
+            )
+        )
+
+
+# tracemalloc is process wide, so phases are measured one at a time
+_TRACE_LOCK = threading.RLock()
+
+
+def _measure(stats, phase, method, *args):
+    """
+    Call method, recording its time and peak allocations as a phase
+    """
+    reset_peak = getattr(tracemalloc, 'reset_peak', None)
+    with _TRACE_LOCK:
+        owned = not tracemalloc.is_tracing()
+        if owned:
+            tracemalloc.start()
+        elif reset_peak is not None:
+            reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            seconds = time.perf_counter() - start
+            peak = None
+            if owned or reset_peak is not None:
+                peak = tracemalloc.get_traced_memory()[1] - current
+            if owned:
+                tracemalloc.stop()
+            stats.phases[phase] = PhaseStats(seconds, peak)
+
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+# Local liveness over basic blocks, see Assembler._local_liveness
+_Liveness = namedtuple(
+    '_Liveness', 'starts ends live_in live_out pinned deleted'
+)
+
+
+class CodeCache:
+    """
+    Bounded LRU cache of assembled code objects, so that assembling
+    the same source with the same constants gives back one shared
+    code object
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached code object for key or None
+        """
+        with self._lock:
+            co = self._entries.get(key)
+            if co is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return co
+
+    def put(self, key, co):
+        """
+        Add a code object, evicting the least recently used entries
+        if the cache is full
+        """
+        with self._lock:
+            self._entries[key] = co
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def clear(self):
+        """
+        Drop all entries and reset the hit/miss counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def resize(self, maxsize):
+        """
+        Change the maximum number of entries, evicting as needed
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def info(self):
+        """
+        Hit/miss statistics, as with functools.lru_cache
+        """
+        with self._lock:
+            return CacheInfo(
+                self.hits, self.misses, self.maxsize, len(self._entries)
+            )
+
+    def _evict(self):
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+CODE_CACHE = CodeCache()
+
+# Code objects made by specialize, keyed on the template and the bindings
+SPECIALIZE_CACHE = CodeCache()
+
+
+def specialize(template, **bindings):
+    """
+    Assemble a template with the keyword values as named constants,
+    optimized so that branches on them are pruned. The template is asm
+    source, giving a code object, or a function with asm source in its
+    docstring (not decorated with asm), giving a function.
+
+    Results are kept in SPECIALIZE_CACHE keyed on the template and the
+    values, so the same specialization is only assembled once. Values
+    that can't be hashed are assembled every time.
+    """
+    key = (template, tuple(sorted(
+        (name, _const_key(value)) for name, value in bindings.items()
+    )))
+    try:
+        hash(key)
+    except TypeError:
+        key = None
+    co = None if key is None else SPECIALIZE_CACHE.get(key)
+    if co is None:
+        co = _specialize(template, bindings)
+        if key is not None:
+            SPECIALIZE_CACHE.put(key, co)
+    if isinstance(template, str):
+        return co
+    return _make_function(template, co)
+
+
+def _specialize(template, bindings):
+    options = {'optimize': 1, 'bindings': bindings}
+    if isinstance(template, str):
+        return Assembler(template, **options).assemble()
+    doc, source = template.__doc__.split(':::asm')
+    co_gen, _ = _assemble_source(
+        source, doc, template.__code__, (), options,
+        namespace=template.__globals__
+    )
+    return _function_code(co_gen, template.__code__)
+
+
+def _const_key(value):
+    """
+    Key for a constant that tells apart values which compare equal
+    but are different constants, such as 1, 1.0 and True or 0.0 and -0.0
+    """
+    if isinstance(value, tuple):
+        return (type(value), tuple(_const_key(v) for v in value))
+    if isinstance(value, frozenset):
+        return (type(value), frozenset(_const_key(v) for v in value))
+    if isinstance(value, (float, complex)):
+        return (type(value), repr(value))
+    return (type(value), value)
+
+
+def _cache_entry(f, source, doc, args, options):
+    """
+    Locate the cache file for an assembled function and compute the key
+    its contents have to match. Returns None if the function can't be
+    cached, i.e. it wasn't defined in a file or the args can't be
+    marshalled.
+
+    The key covers everything that goes into the assembled code object
+    besides the function name and filename, so changing any of it
+    makes the old entry stale, as does changing the assembler options.
+    Functions binding globals aren't cached, as the bound objects are
+    looked up on each run.
+    """
+    if not DISK_CACHE or _binds_globals(source, options):
+        return None
+    if options.get('layout_profile') is not None:
+        # key on the counts rather than the file they are in
+        options = dict(options, layout_profile=tuple(sorted(
+            _load_layout_profile(options['layout_profile']).items()
+        )))
+    co_in = f.__code__
+    if not os.path.isfile(co_in.co_filename):
+        return None
+    try:
+        # version 2 has no object refs, so equal inputs give equal bytes
+        blob = marshal.dumps((
+            source,
+            doc,
+            args,
+            tuple(sorted(options.items())),
+            co_in.co_firstlineno,
+            co_in.co_flags,
+            co_in.co_varnames
+        ), 2)
+    except ValueError:
+        return None
+    key = hashlib.sha256(MAGIC_NUMBER + _assembler_digest() + blob).digest()
+
+    # one file per function, so editing it doesn't leave old entries
+    # behind. The key stored in it tells whether it is current.
+    head, tail = os.path.split(co_in.co_filename)
+    name = '{0}.{1}.{2}.asm'.format(
+        os.path.splitext(tail)[0],
+        re.sub(r'[^\w.]', '_', f.__qualname__),
+        sys.implementation.cache_tag
+    )
+    return os.path.join(head, '__pycache__', name), key
+
+
+def _assembler_digest():
+    """
+    Digest of the assembler itself, so that cache entries written by a
+    different version (or a locally modified copy) are never used
+    """
+    global _ASSEMBLER_DIGEST
+    if _ASSEMBLER_DIGEST is None:
+        digest = hashlib.sha256(__version__.encode())
+        package = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(package)):
+            if name.endswith('.py'):
+                with open(os.path.join(package, name), 'rb') as fp:
+                    digest.update(fp.read())
+        _ASSEMBLER_DIGEST = digest.digest()
+    return _ASSEMBLER_DIGEST
+
+
+def _cache_load(path, key):
+    """
+    Load a cached code object, or return None if there is no cache
+    file or it is stale
+    """
+    try:
+        with open(path, 'rb') as fp:
+            data = fp.read()
+    except OSError:
+        return None
+    header = MAGIC_NUMBER + key
+    if not data.startswith(header):
+        return None
+    try:
+        return marshal.loads(data[len(header):])
+    except (EOFError, ValueError, TypeError):
+        return None
+
+
+def _cache_store(path, key, code):
+    """
+    Write a code object to the cache. The file is written under a
+    temporary name and moved into place so that concurrent readers
+    never see a partial file. Failures are ignored, as with .pyc files.
+    """
+    if sys.dont_write_bytecode:
+        return
+    tmp = '{0}.{1}.{2}'.format(path, os.getpid(), threading.get_ident())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'wb') as fp:
+            fp.write(MAGIC_NUMBER + key + marshal.dumps(code))
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+Token = namedtuple('Token', 'kind lno value arg')
+
+# Directives opening a block of code expanded by the Assembler, and the
+# directive closing each
+_BLOCKS = {'macro': 'endm', 'repeat': 'endr'}
+_BLOCK_ENDS = {end: start for start, end in _BLOCKS.items()}
+# Directives that annotate the code where they stand, without changing
+# the section
+_INLINE = frozenset(_BLOCKS) | frozenset(_BLOCK_ENDS) | {'unroll'}
+
+
+def tokenize(source):
+    """
+    Lazily split asm source into tokens in a single pass. The source can
+    be a string, a file object or any iterable of lines.
+
+    Yields a ``directive`` token for each section header, a ``line``
+    token for each line of a data section (including the remainder of a
+    header line, for example ``.stacksize 4``) and ``label`` and ``op``
+    tokens in the code section, with the operand (if any) as arg.
+    Comments and blank lines are dropped, and lno counts source lines
+    from 0.
+
+    The ``.macro``, ``.endm``, ``.repeat``, ``.endr`` and ``.unroll``
+    directives don't change the section. Their remainder is the arg of
+    the directive token, and lines between a block directive and its
+    end are always code.
+    """
+    if isinstance(source, str):
+        source = io.StringIO(source)
+    section = None
+    depth = 0
+    for lno, line in enumerate(source):
+        line = line.split(';', 1)[0].strip()
         if not line:
             continue
         if line.startswith('.'):
-                tokens = line[1:].split()
-                sections[tokens[0]] = []
-                current_section = tokens[0]
-                if len(tokens) > 1:
-                    if current_section == 'code':
-                        sections[tokens[0]].append((lno, ''.join(tokens[1:])))
-                    else:
-                        sections[tokens[0]].append(''.join(tokens[1:]))
+            tokens = line[1:].split(None, 1)
+            directive = tokens[0]
+            if directive in _INLINE:
+                if directive in _BLOCKS:
+                    depth += 1
+                elif directive in _BLOCK_ENDS:
+                    depth -= 1
+                arg = tokens[1] if len(tokens) > 1 else None
+                yield Token('directive', lno, directive, arg)
+                continue
+            section = directive
+            yield Token('directive', lno, section, None)
+            if len(tokens) == 1:
                 continue
-        if current_section == 'code':
-            sections[current_section].append((lno, line))
+            line = tokens[1]
+        if section == 'code' or depth > 0:
+            label, op, arg = _split_code(line)
+            if label is not None:
+                yield Token('label', lno, label, None)
+            if op is not None:
+                yield Token('op', lno, op, arg)
         else:
-            sections[current_section].append(line)
+            yield Token('line', lno, line, None)
+
+
+def _tokenize_code(lno, line):
+    """
+    Tokenize one line of the code section, which can hold a label,
+    an instruction or both, or an ``.unroll``
+    """
+    if line.startswith('.'):
+        tokens = line[1:].split(None, 1)
+        yield Token('directive', lno, tokens[0], ' '.join(tokens[1:]) or None)
+        return
+    label, op, arg = _split_code(line)
+    if label is not None:
+        yield Token('label', lno, label, None)
+    if op is not None:
+        yield Token('op', lno, op, arg)
+
+
+def _split_code(line):
+    """
+    Split a line of code into its label, opname and operand, any of
+    which can be None
+    """
+    label = None
+    if ':' in line:
+        label, line = line.split(':', 1)
+        label = label.strip()
+    tokens = line.split(None, 1)
+    if not tokens:
+        return label, None, None
+    if len(tokens) == 1:
+        return label, tokens[0].upper(), None
+    return label, tokens[0].upper(), tokens[1]
+
+
+def preprocess(source):
+    """
+    Split source into a dict of sections, with the line number kept
+    with each line of the code section.
+
+    The Assembler reads source straight from tokenize, this is
+    kept for inspecting a source by section.
+    """
+    sections = {'unknown': []}
+    current_section = 'unknown'
+    for token in tokenize(source):
+        if token.kind == 'directive' and token.value in _INLINE:
+            line = '.' + token.value
+            if token.arg is not None:
+                line += ' ' + token.arg
+            sections[current_section].append((token.lno, line))
+        elif token.kind == 'directive':
+            current_section = token.value
+            sections[current_section] = []
+        elif token.kind == 'line':
+            sections[current_section].append(token.value)
+        elif token.kind == 'label':
+            sections[current_section].append((token.lno, token.value + ':'))
+        elif token.arg is None:
+            sections[current_section].append((token.lno, token.value))
+        else:
+            sections[current_section].append(
+                (token.lno, '{0} {1}'.format(token.value, token.arg))
+            )
 
     return sections
 
@@ -121,16 +1012,50 @@ class Assembler:
     """
     I *think* I want to make this a class
     """
-    def __init__(self, source=None, doc=None, code=None, args=None):
+    def __init__(self, source=None, doc=None, code=None, args=None,
+                 optimize=0, stats=False, bind_globals=(), namespace=None,
+                 bindings=None, layout_profile=None, lnodoc=None):
         """
-        Can be passed source to be preprocessed or
-        you can add sections manually (mainly for
-        testing convenience)
+        Can be passed source (a string, file object or iterable
+        of lines) to be tokenized or you can add sections manually
+        (mainly for testing convenience)
+
+        Line i of the source is put at line code.co_firstlineno +
+        lnodoc + 1 + i, where lnodoc defaults to the number of lines
+        of doc
+
+        With optimize > 0 the bytecode goes through a peephole pass
+        before it is laid out, and from 2 locals share slots where they
+        can and rarely run blocks are moved to the end
+
+        layout_profile gives the run counts of source lines (a dict, or
+        the path of a JSON file from Profile.dump) to find rarely run
+        blocks by, in place of the heuristics
+
+        With stats set, the time and memory taken by each step is
+        recorded in an AssemblyStats as self.stats
+
+        bind_globals names globals (or is True for all of them) to be
+        looked up at assembly time in namespace, then builtins, and
+        loaded as constants, as with the ``.bind`` directive
+
+        bindings is a dict of values to use as named constants, in place
+        of any ``.consts`` entry of the same name, see specialize
         """
+        self.src = {}
+        self.targets = {}
+        self.bytecode = []
+        self.bytecode_lno = []
+        self.stats = AssemblyStats() if stats else None
+        self.macros = {}
+        # names of the macros being expanded, innermost last
+        self._expanding = []
+        self.expansions = 0
+        # loop label -> (count, lno) of each .unroll
+        self.unrolls = {}
+        self._unroll = None
         if source is not None:
-            self.src = preprocess(source)
-        else:
-            self.src = {}
+            self._step('read', self._read, tokenize(source))
 
         self.flags = 0
         self.fl = 0
@@ -140,13 +1065,22 @@ class Assembler:
             self.flags = code.co_flags
             self.varnames = code.co_varnames
 
-        self.targets = {}
         self.code = None
         self.argcount = len(self.varnames)
         self.locals = list(self.varnames)
         self.doc = doc
         self.args = args
-        if doc is not None:
+        self.optimize = optimize
+        self.bind_globals = bind_globals
+        self.namespace = namespace
+        self.bindings = bindings or {}
+        self.layout_profile = None
+        if layout_profile is not None:
+            self.layout_profile = _load_layout_profile(layout_profile)
+        self.bound = {}
+        if lnodoc is not None:
+            self.lnodoc = lnodoc
+        elif doc is not None:
             self.lnodoc = len(doc.splitlines())
         else:
             self.lnodoc = 0
@@ -155,18 +1089,33 @@ class Assembler:
         """
         Assemble source into a types.CodeType object and return it
         """
-        self.assemble_stacksize()
-        self.assemble_flags()
-        self.assemble_params()
-        self.assemble_locals()
-        self.assemble_names()
-        self.assemble_freevars()
-        self.assemble_cellvars()
-        self.assemble_consts()
-        self.assemble_code()
-        self.assemble_lnotab()
-
-        return types.CodeType(
+        self._step('consts', self.assemble_consts)
+        if self.bind_globals or 'bind' in self.src:
+            self._step('bind', self.assemble_bind)
+        key = self._cache_key()
+        if key is not None:
+            co = CODE_CACHE.get(key)
+            if co is not None:
+                if self.stats is not None:
+                    self.stats.cached = 'memory'
+                return co
+
+        self._step('stacksize', self.assemble_stacksize)
+        self._step('flags', self.assemble_flags)
+        self._step('params', self.assemble_params)
+        self._step('locals', self.assemble_locals)
+        self._step('names', self.assemble_names)
+        self._step('freevars', self.assemble_freevars)
+        self._step('cellvars', self.assemble_cellvars)
+        self._step('optimize', self.assemble_optimize)
+        self._step('code', self.assemble_code)
+        self._step('lnotab', self.assemble_lnotab)
+        if self.stacksize is None:
+            self.stacksize = self._step(
+                'max_stack_depth', max_stack_depth, self.code
+            )
+
+        co = types.CodeType(
             self.argcount,
             0,
             len(self.varnames),
@@ -183,14 +1132,67 @@ class Assembler:
             self.freevars,
             self.cellvars
         )
+        if key is not None:
+            CODE_CACHE.put(key, co)
+        return co
 
-    def assemble_stacksize(self):
+    def _step(self, phase, method, *args):
         """
-        obviously - come back to this when its time to
-        add reasonable error messages
+        Call method, measuring it as a phase when collecting stats
         """
-        self.stacksize = int(self.src['stacksize'][0])
-        
+        if self.stats is None:
+            return method(*args)
+        return _measure(self.stats, phase, method, *args)
+
+    def _cache_key(self):
+        """
+        Key for the in-process code cache, made of the tokenized
+        source, the resolved constants and whatever was taken from the
+        original code object. Returns None if a constant is unhashable.
+
+        On a cache hit the code object is shared, so the assemble_*
+        attributes past the consts are not filled in.
+        """
+        for section, lines in self.src.items():
+            self.src[section] = tuple(lines)
+        key = (
+            tuple(sorted(self.src.items())),
+            tuple(self.bytecode),
+            tuple(self.bytecode_lno),
+            tuple(sorted(self.targets.items())),
+            tuple(sorted(self.unrolls.items())),
+            _const_key(self.consts),
+            tuple(sorted(self.bindings)),
+            tuple(sorted(
+                (name, _const_key(value)) for name, value in self.bound.items()
+            )),
+            self.fl,
+            self.lnodoc,
+            self.flags,
+            tuple(self.locals),
+            self.optimize,
+            tuple(sorted((self.layout_profile or {}).items())),
+        )
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def assemble_stacksize(self):
+        """
+        obviously - come back to this when its time to
+        add reasonable error messages
+
+        If the stacksize is omitted or given as ``auto`` it is
+        computed from the bytecode once that has been assembled
+        """
+        lines = self.src.get('stacksize')
+        if not lines or lines[0].lower() == 'auto':
+            self.stacksize = None
+        else:
+            self.stacksize = int(lines[0])
+        
     def assemble_consts(self):
         """
         Consts must be in the .consts section one per line in
@@ -200,21 +1202,77 @@ class Assembler:
 
         As with the CPython compiler, the first constant in the list
         will be the docstring. This will be given the name "__doc__"
+
+        Literals are parsed once per distinct expression and shared
+        between assemblies. Anything else is evaluated with only the
+        builtins, ``args`` (the decorator arguments) and the bindings
+        in scope. Each binding is a constant under its own name,
+        replacing a constant of the same name.
         """
         consts = [self.doc]
         aliases = {'__doc__': 0}
+        scope = dict(self.bindings, args=self.args)
         for idx, line in enumerate(self.src.get('consts', ())):
-            tokens = [t.strip() for t in line.split('=')]
-            args = self.args
-            if len(tokens) == 1:
-                consts.append(eval(tokens[0]))
+            alias, expr = _split_const(line)
+            literal, value = _parse_const(expr)
+            if not literal:
+                value = eval(value, {'__builtins__': builtins}, scope)
+            consts.append(value)
+            if alias is not None:
+                aliases[alias.lower()] = idx + 1
+        for name, value in self.bindings.items():
+            alias = name.lower()
+            if alias in aliases:
+                consts[aliases[alias]] = value
             else:
-                consts.append(eval(tokens[1]))
-                aliases[tokens[0].lower()] = idx + 1
+                aliases[alias] = len(consts)
+                consts.append(value)
 
         self.consts = tuple(consts)
         self.consts_alias = aliases
 
+    def assemble_bind(self):
+        """
+        Look up the globals to bind, given comma separated in ``.bind``
+        directives or by the bind_globals option, in the namespace and
+        then the builtins. A bare ``.bind`` (or bind_globals=True)
+        binds every global loaded by the code that can be found, named
+        globals that can't be found raise NameError.
+        """
+        names = set()
+        bind_all = self.bind_globals is True
+        if not bind_all:
+            names.update(self.bind_globals)
+        if 'bind' in self.src:
+            lines = self.src['bind']
+            bind_all = bind_all or not lines
+            for line in lines:
+                names.update(s.strip() for s in line.split(','))
+        if not names and not bind_all:
+            return
+
+        loaded = set()
+        if bind_all:
+            self.assemble_names()
+            load_global = opmap['LOAD_GLOBAL']
+            for idx in range(0, len(self.bytecode), 2):
+                if self.bytecode[idx] == load_global:
+                    arg = self.bytecode[idx+1]
+                    if isinstance(arg, int):
+                        arg = self.names[arg]
+                    loaded.add(arg)
+
+        namespace = self.namespace or {}
+        for name in sorted(names | loaded):
+            if name in namespace:
+                self.bound[name] = namespace[name]
+            elif hasattr(builtins, name):
+                self.bound[name] = getattr(builtins, name)
+            elif name in names:
+                raise NameError(
+                    "name '{0}' is not defined and can't be bound".format(name)
+                )
+
     def assemble_params(self):
         """
         Function parameters. These can either be specified
@@ -257,6 +1315,17 @@ class Assembler:
                     flag = CO_FLAGS[flagstr.upper()]
                 self.flags |= flag
                 
+    def assemble_optimize(self):
+        """
+        Optimization level, overriding the one given to the Assembler.
+        A bare ``.optimize`` directive means level 1
+        """
+        if 'optimize' not in self.src:
+            return
+
+        lines = self.src['optimize']
+        self.optimize = int(lines[0]) if lines else 1
+
     def assemble_names(self):
         """
         Names
@@ -290,203 +1359,1561 @@ class Assembler:
             cellvars.extend([s.strip() for s in line.split(',')])
         self.cellvars = tuple(cellvars)
 
+    def _read(self, tokens):
+        """
+        Consume a token stream. Lines of data sections are collected
+        in src and code is added to the bytecode as it is read, so the
+        code section is never held as text.
+
+        The tokens of ``.macro`` and ``.repeat`` blocks are kept as
+        they are read, and expanded from there without going back to
+        the source.
+        """
+        section = self.src.setdefault('unknown', [])
+        blocks = []
+        macros = self.macros
+        add_code = self._add_code
+        for token in tokens:
+            kind = token.kind
+            if kind == 'op' or kind == 'label':
+                if blocks:
+                    blocks[-1][1].append(token)
+                elif macros and kind == 'op' and token.value in macros:
+                    self._add_token(token)
+                else:
+                    add_code(token)
+            elif kind == 'line':
+                section.append(token.value)
+            elif token.value == 'unroll':
+                if blocks:
+                    blocks[-1][1].append(token)
+                else:
+                    self._add_token(token)
+            elif token.value in _BLOCKS:
+                blocks.append((token, []))
+            elif token.value in _BLOCK_ENDS:
+                self._end_block(token, blocks)
+            elif blocks:
+                raise ValueError('line {0}: .{1} inside a .{2} block'.format(
+                    token.lno, token.value, blocks[-1][0].value
+                ))
+            else:
+                section = self.src.setdefault(token.value, [])
+        if blocks:
+            start = blocks[-1][0]
+            raise ValueError('line {0}: .{1} without .{2}'.format(
+                start.lno, start.value, _BLOCKS[start.value]
+            ))
+
+    def _end_block(self, end, blocks):
+        """
+        Close a block: define a macro, or expand a repeat where it is
+        (into the enclosing block, if any)
+        """
+        if not blocks or blocks[-1][0].value != _BLOCK_ENDS[end.value]:
+            raise ValueError('line {0}: unexpected .{1}'.format(
+                end.lno, end.value
+            ))
+        start, body = blocks.pop()
+        if start.value == 'macro':
+            if blocks:
+                raise ValueError(
+                    'line {0}: .macro inside a block'.format(start.lno)
+                )
+            name, _, params = (start.arg or '').partition(' ')
+            if not name:
+                raise ValueError('line {0}: .macro needs a name'.format(
+                    start.lno
+                ))
+            params = [p.strip() for p in params.split(',') if p.strip()]
+            self.macros[name.upper()] = _Macro(name, params, body)
+            return
+
+        try:
+            count = int(start.arg)
+        except (TypeError, ValueError):
+            count = 0
+        if count < 1:
+            raise ValueError('line {0}: .repeat needs a count'.format(
+                start.lno
+            ))
+        copies = (self._local_labels(body) for _ in range(count))
+        if blocks:
+            for copy in copies:
+                blocks[-1][1].extend(copy)
+        else:
+            for copy in copies:
+                for token in copy:
+                    self._add_token(token)
+
+    def _add_token(self, token, lno=None):
+        """
+        Add a label or instruction token to the bytecode, expanding
+        macros. lno overrides the line number of the token.
+        """
+        if token.kind == 'op' and token.value in self.macros:
+            macro = self.macros[token.value]
+            if token.value in self._expanding:
+                raise ValueError('line {0}: recursive macro {1}'.format(
+                    token.lno, macro.name
+                ))
+            if lno is None:
+                lno = token.lno
+            self._expanding.append(token.value)
+            for inner in self._local_labels(macro.expand(token)):
+                self._add_token(inner, lno)
+            self._expanding.pop()
+        else:
+            self._add_code(token, lno)
+
+    def _local_labels(self, body):
+        """
+        The tokens of a block body with its labels renamed for one
+        copy, so that each copy jumps within itself. Only the operands
+        of jumps are labels, others are left alone even if they have
+        the name of one.
+        """
+        labels = {token.value for token in body if token.kind == 'label'}
+        if not labels:
+            return body
+        self.expansions += 1
+        suffix = '@{0}'.format(self.expansions)
+        copy = []
+        for token in body:
+            if token.kind == 'label':
+                token = token._replace(value=token.value + suffix)
+            elif token.arg in labels and token.value in _JUMP_NAMES:
+                token = token._replace(arg=token.arg + suffix)
+            copy.append(token)
+        return copy
+
+    def _add_code(self, token, lno=None):
+        """
+        Add a label or instruction token to the bytecode, or note an
+        ``.unroll`` for the next label
+        """
+        if token.kind == 'label':
+            self.targets[token.value] = len(self.bytecode)
+            if self._unroll is not None:
+                self.unrolls[token.value] = self._unroll
+                self._unroll = None
+            return
+        if token.kind == 'directive':
+            self._add_unroll(token)
+            return
+
+        opcode = opmap[token.value]
+        self.bytecode.append(opcode)
+        self.bytecode_lno.append(token.lno if lno is None else lno)
+        if opcode >= HAVE_ARGUMENT:
+            arg = token.arg
+            try:
+                arg = int(arg)
+            except ValueError:
+                pass
+            self.bytecode.append(arg)
+        else:
+            self.bytecode.append(0)
+
+    def _add_unroll(self, token):
+        if token.value != 'unroll':
+            raise ValueError('line {0}: .{1} inside the code'.format(
+                token.lno, token.value
+            ))
+        try:
+            count = int(token.arg)
+        except (TypeError, ValueError):
+            count = 0
+        if count < 1:
+            raise ValueError('line {0}: .unroll needs a count'.format(
+                token.lno
+            ))
+        self._unroll = (count, token.lno)
+
     def assemble_code(self):
         """
         Assuming everything else has gone correctly, produce the bytecode
+
+        Code read from the source is already in the bytecode, a code
+        section added manually as (lno, line) pairs is tokenized here.
         """
-        bytecode = []
-        bytecode_lno = []
-        pos = 0
-        for lno, line in self.src['code']:
+        for lno, line in self.src.pop('code', ()):
+            for token in _tokenize_code(lno, line):
+                self._add_token(token)
+
+        if self._unroll is not None:
+            raise ValueError('line {0}: .unroll without a loop label'.format(
+                self._unroll[1]
+            ))
+        if self.unrolls:
+            self._unroll_loops()
+        if self.bound:
+            self._bind_globals()
+        self._fix_arguments()
+        if self.optimize:
+            self._optimize()
+        if self.optimize >= 2:
+            self._eliminate_dead_stores()
+            self._prune_tables()
+            self._compact_locals()
+        if self.optimize >= 2 or self.layout_profile is not None:
+            self._layout_blocks()
+        count = len(self.bytecode) // 2
+        self._relax_arguments()
+        self.code = bytes(self.bytecode)
+        if self.stats is not None:
+            self.stats.instructions = count
+            self.stats.extended_args = len(self.code) // 2 - count
+
+    def _unroll_loops(self):
+        """
+        Unroll each loop marked with ``.unroll N``: a label on a
+        FOR_ITER whose exit target comes right after the
+        ``JUMP_ABSOLUTE`` back to the label. The FOR_ITER and the body
+        are repeated N times before the jump back, so N items are taken
+        per jump. Each copy keeps its FOR_ITER, which leaves the loop
+        whenever the iterator runs out, so there is no remainder to
+        handle and every copy stores its own item.
 
-            line = self._extract_target(line, pos)
-            if not line:
+        Labels in the body are local to each copy, and copies keep the
+        line numbers of the original instructions. Loops are unrolled
+        from the last one up, so an inner loop is unrolled before the
+        loop containing it is copied.
+
+        Unrolling moves the code after each loop, which only labels
+        follow, so every jump in the code has to go to a label.
+        """
+        for_iter = opmap['FOR_ITER']
+        jump_absolute = opmap['JUMP_ABSOLUTE']
+        bytecode = self.bytecode
+        bytecode_lno = self.bytecode_lno
+        targets = self.targets
+        for idx in range(0, len(bytecode), 2):
+            if _OPCODE_KIND[bytecode[idx]] in (_ARG_JABS, _ARG_JREL) and (
+                not isinstance(bytecode[idx+1], str)
+            ):
+                raise ValueError(
+                    'line {0}: jumps in code with .unroll need '
+                    'labels'.format(bytecode_lno[idx//2])
+                )
+        loops = sorted(
+            self.unrolls.items(), key=lambda item: targets[item[0]],
+            reverse=True
+        )
+        for label, (count, lno) in loops:
+            start = targets[label]
+            if start >= len(bytecode) or bytecode[start] != for_iter:
+                raise ValueError(
+                    'line {0}: .unroll needs {1} on a FOR_ITER'.format(
+                        lno, label
+                    )
+                )
+            end = targets.get(bytecode[start+1])
+            jump = -1 if end is None else end - 2
+            if jump <= start or bytecode[jump] != jump_absolute or (
+                bytecode[jump+1] != label
+            ):
+                raise ValueError(
+                    'line {0}: .unroll needs the loop {1} to end with '
+                    'JUMP_ABSOLUTE {1} before its exit'.format(lno, label)
+                )
+            if count == 1:
                 continue
 
-            tokens = line.split()
-            op = tokens[0].upper()
-            opcode = opmap[op]
-            bytecode.append(opcode)
-            bytecode_lno.append(lno)
-            if opcode >= HAVE_ARGUMENT:
-                arg = tokens[1]
-                try:
-                    arg = int(arg)
-                except ValueError:
-                    pass
-                bytecode.append(arg)
-            else:
-                bytecode.append(0)
-            pos += 2
+            body = bytecode[start:jump]
+            body_lno = bytecode_lno[start//2:jump//2]
+            labels = {
+                name: pos - start for name, pos in targets.items()
+                if start < pos <= jump
+            }
+            jumps = []
+            for idx in range(0, len(body), 2):
+                if _OPCODE_KIND[body[idx]] in (_ARG_JABS, _ARG_JREL) and (
+                    body[idx+1] in labels
+                ):
+                    jumps.append(idx + 1)
 
-        self.bytecode = bytecode
-        self.bytecode_lno = bytecode_lno
-        self._fix_arguments()
-        self.code = bytes(bytecode)
+            inserted = (count - 1) * len(body)
+            for name, pos in targets.items():
+                if pos > jump:
+                    targets[name] = pos + inserted
+            copies = []
+            for copy in range(count - 1):
+                self.expansions += 1
+                suffix = '@{0}'.format(self.expansions)
+                base = jump + copy * len(body)
+                for name, offset in labels.items():
+                    targets[name + suffix] = base + offset
+                ops = list(body)
+                for idx in jumps:
+                    ops[idx] += suffix
+                copies.extend(ops)
+            bytecode[jump:jump] = copies
+            bytecode_lno[jump//2:jump//2] = body_lno * (count - 1)
 
-    def _extract_target(self, line, pos):
+    def _bind_globals(self):
         """
-        Extract a target (if any) from the line and return what remains.
-        Add the target position to the dict of targets.
+        Replace LOAD_GLOBAL of the bound names with LOAD_CONST of their
+        values, and drop the names nothing refers to any more
         """
-        tokens = line.split(':')
-        if len(tokens) == 1:
-            return line
-        target, ops = tokens
-        self.targets[target] = pos
-        return ops
+        load_global = opmap['LOAD_GLOBAL']
+        load_const = opmap['LOAD_CONST']
+        bytecode = self.bytecode
+        names = self.names
+        consts = list(self.consts)
+        positions = {}
+        for idx in range(0, len(bytecode), 2):
+            if bytecode[idx] != load_global:
+                continue
+            name = bytecode[idx+1]
+            if isinstance(name, int):
+                name = names[name]
+            if name not in self.bound:
+                continue
+            value = self.bound[name]
+            pos = positions.get(id(value))
+            if pos is None:
+                pos = positions[id(value)] = len(consts)
+                consts.append(value)
+            bytecode[idx] = load_const
+            bytecode[idx+1] = pos
+        self.consts = tuple(consts)
+
+        used = set()
+        for idx in range(0, len(bytecode), 2):
+            if _OPCODE_KIND[bytecode[idx]] == _ARG_NAME:
+                arg = bytecode[idx+1]
+                used.add(names[arg] if isinstance(arg, int) else arg)
+        keep = [
+            name for name in names if name in used or name not in self.bound
+        ]
+        if len(keep) == len(names):
+            return
+        new_index = _index_table(keep)
+        for idx in range(0, len(bytecode), 2):
+            if _OPCODE_KIND[bytecode[idx]] == _ARG_NAME:
+                arg = bytecode[idx+1]
+                if isinstance(arg, int):
+                    bytecode[idx+1] = new_index[names[arg]]
+        self.names = tuple(keep)
 
     def _fix_arguments(self):
         """
         Replace target tuples in bytecode with correct positions or
         variable indices
         """
-        # first pass, replace non-int arguments with integer values
-        for idx in range(0, len(self.bytecode), 2):
-            arg = self.bytecode[idx+1]
+        # first pass, replace non-int arguments with integer values.
+        # Jumps (absolute and relative) are left as absolute positions
+        # in the unextended bytecode until the arguments are relaxed
+        bytecode = self.bytecode
+        tables = self._symbol_tables()
+        for idx in range(0, len(bytecode), 2):
+            arg = bytecode[idx+1]
+            kind = _OPCODE_KIND[bytecode[idx]]
             if not isinstance(arg, str):
+                if kind == _ARG_JREL:
+                    bytecode[idx+1] = arg + idx + 2
+                continue
+            bytecode[idx+1] = tables[kind][arg]
+
+    def _symbol_tables(self):
+        """
+        Dicts from symbolic argument to index for each kind of operand,
+        indexed by kind. Where a name is repeated the first index wins,
+        and cell variables shadow free variables.
+        """
+        cellvars = getattr(self, 'cellvars', ())
+        freecells = _index_table(getattr(self, 'freevars', ()), len(cellvars))
+        freecells.update(_index_table(cellvars))
+
+        tables = [{}] * len(_ARG_KINDS)
+        tables[_ARG_JABS] = self.targets
+        tables[_ARG_JREL] = self.targets
+        tables[_ARG_LOCAL] = _index_table(self.locals)
+        tables[_ARG_NAME] = _index_table(getattr(self, 'names', ()))
+        tables[_ARG_CONST] = getattr(self, 'consts_alias', {})
+        tables[_ARG_FREE] = freecells
+        return tables
+
+    def _optimize(self):
+        """
+        Peephole pass over the resolved bytecode, before the arguments
+        are relaxed. Operations on constants are folded, then jumps to
+        unconditional jumps are threaded through to the final target and
+        NOPs, unreachable code and jumps to the next instruction are
+        dropped, until nothing changes.
+
+        Line numbers are removed along with their instructions, so the
+        lnotab stays correct.
+        """
+        self._fold_constants()
+        changed = True
+        while changed:
+            changed = self._thread_jumps()
+            live = self._live_instructions()
+            changed = self._remove_instructions(live) or changed
+
+    def _fold_constants(self):
+        """
+        Evaluate unary and binary operations, comparisons and
+        BUILD_TUPLE over constants at assembly time, replacing each
+        with one LOAD_CONST in place of the first operand and NOPs for
+        the rest. A POP_JUMP_IF_* on a constant becomes a jump or
+        nothing. Only runs of LOAD_CONST that no jump lands in the
+        middle of are folded.
+
+        As with the CPython peephole optimizer, results with more than
+        20 items are left alone. A folded value that is already a
+        constant reuses its entry.
+        """
+        bytecode = self.bytecode
+        count = len(bytecode) // 2
+        jump_targets = set()
+        for idx in range(0, len(bytecode), 2):
+            kind = _OPCODE_KIND[bytecode[idx]]
+            if kind == _ARG_JABS or kind == _ARG_JREL:
+                jump_targets.add(bytecode[idx+1] // 2)
+
+        consts = list(getattr(self, 'consts', ()))
+        const_index = {}
+        for idx, value in enumerate(consts):
+            try:
+                const_index.setdefault(_const_key(value), idx)
+            except TypeError:
+                pass
+
+        load_const = opmap['LOAD_CONST']
+        nop = opmap['NOP']
+        run = []
+        for idx in range(count):
+            if idx in jump_targets:
+                run = []
+            op = bytecode[2*idx]
+            if op == load_const:
+                run.append(idx)
+                continue
+            if op == nop:
+                continue
+
+            if op in _CONDITIONAL_JUMPS and run:
+                self._fold_branch(idx, run.pop(), consts)
+                run = []
+                continue
+            if op in _UNARY_FOLDS:
+                size = 1
+            elif op in _BINARY_FOLDS:
+                size = 2
+            elif op == opmap['COMPARE_OP'] and (
+                bytecode[2*idx+1] < len(_COMPARE_FOLDS)
+            ):
+                size = 2
+            elif op == opmap['BUILD_TUPLE']:
+                size = bytecode[2*idx+1]
+            else:
+                run = []
+                continue
+            if size > len(run):
+                run = []
                 continue
-            if self.bytecode[idx] in hasjabs:
-                self.bytecode[idx+1] = self.targets[arg]
-            elif self.bytecode[idx] in hasjrel:
-                self.bytecode[idx+1] = (
-                    self.targets[arg] - (idx + 2)
+
+            loads = run[len(run)-size:]
+            try:
+                value = _fold(
+                    op, [consts[bytecode[2*i+1]] for i in loads],
+                    bytecode[2*idx+1]
                 )
-            elif self.bytecode[idx] in haslocal:
-                self.bytecode[idx+1] = self.locals.index(arg)
-            elif self.bytecode[idx] in hasname:
-                self.bytecode[idx+1] = self.names.index(arg)
-            elif self.bytecode[idx] in hasconst:
-                self.bytecode[idx+1] = self.consts_alias[arg]
-            elif self.bytecode[idx] in hasfree:
-                self.bytecode[idx+1] = self._find_freecell(arg)
-
-        # second pass (quadratic), use EXTENDED_ARG ops as needed
-        # to reduce down arguments to < 256
-        reduced = False
-        while not reduced:
-            reduced = self._reduce_next_arg()
-
-    def _find_freecell(self, arg):
-        """
-        Locate the free/cell index of the free/cell variable by name
-        """
-        if arg in self.cellvars:
-            return self.cellvars.index(arg)
-        if arg in self.freevars:
-            return self.freevars.index(arg) + len(self.cellvars)
-
-    def _reduce_next_arg(self):
-        """
-        Locate the first instruction with an argument over 255 and
-        reduce it using EXTENDED_ARG
-        """
-        reduced = True
-        for idx in range(0, len(self.bytecode), 2):
-            arg = self.bytecode[idx+1]
-            if arg > 255:
-                reduced = False
-                if idx > 0 and idx-2 == opmap['EXTENDED_ARG']:
-                    self.bytecode[idx-1] += arg >> 8
-                    self.bytecode[idx+1] %= 256
-                else:
-                    self.bytecode[idx+1] %= 256
-                    self._insert_extended_arg(idx, arg >> 8)
-                break
-        return reduced
+            except Exception:
+                run = []
+                continue
+
+            key = _const_key(value)
+            if key not in const_index:
+                const_index[key] = len(consts)
+                consts.append(value)
+
+            for i in loads + [idx]:
+                bytecode[2*i] = nop
+                bytecode[2*i+1] = 0
+            pos = loads[0] if loads else idx
+            bytecode[2*pos] = load_const
+            bytecode[2*pos+1] = const_index[key]
+            del run[len(run)-size:]
+            run.append(pos)
+
+        self.consts = tuple(consts)
+
+    def _fold_branch(self, idx, load, consts):
+        """
+        Resolve a POP_JUMP_IF_* at idx on the constant loaded at load
+        into an unconditional jump or nothing, leaving the branch not
+        taken unreachable
+        """
+        bytecode = self.bytecode
+        value = consts[bytecode[2*load+1]]
+        if not _foldable(value):
+            return
+        nop = opmap['NOP']
+        bytecode[2*load] = nop
+        bytecode[2*load+1] = 0
+        if bool(value) == _CONDITIONAL_JUMPS[bytecode[2*idx]]:
+            bytecode[2*idx] = opmap['JUMP_ABSOLUTE']
+        else:
+            bytecode[2*idx] = nop
+            bytecode[2*idx+1] = 0
+
+    def _thread_jumps(self):
+        """
+        Retarget jumps that land on an unconditional jump, and replace
+        unconditional jumps to a RETURN_VALUE with the return itself
+        """
+        bytecode = self.bytecode
+        end = len(bytecode)
+        changed = False
+        for idx in range(0, end, 2):
+            op = bytecode[idx]
+            kind = _OPCODE_KIND[op]
+            if kind != _ARG_JABS and kind != _ARG_JREL:
+                continue
+
+            target = bytecode[idx+1]
+            seen = set()
+            while (
+                target < end and bytecode[target] in _UNCONDITIONAL_JUMPS
+                and target not in seen
+            ):
+                seen.add(target)
+                target = bytecode[target+1]
+
+            if (
+                op in _UNCONDITIONAL_JUMPS and target < end
+                and bytecode[target] == opmap['RETURN_VALUE']
+            ):
+                bytecode[idx] = opmap['RETURN_VALUE']
+                bytecode[idx+1] = 0
+                changed = True
+                continue
 
-    def _insert_extended_arg(self, pos, val):
+            if target == bytecode[idx+1]:
+                continue
+            # relative jumps can only go forward
+            if kind == _ARG_JREL and target <= idx:
+                if op != opmap['JUMP_FORWARD']:
+                    continue
+                bytecode[idx] = opmap['JUMP_ABSOLUTE']
+            bytecode[idx+1] = target
+            changed = True
+
+        return changed
+
+    def _live_instructions(self):
         """
-        Insert an EXTENDED_ARG opcode at position pos with argument val
-        Then adjust jabs and rel values.
+        Flag the instructions worth keeping: those that can be reached,
+        other than NOPs and unconditional jumps to where execution
+        would go anyway
         """
-        self.bytecode.insert(pos, val)
-        self.bytecode.insert(pos, opmap['EXTENDED_ARG'])
-        self.bytecode_lno.insert(pos // 2, 0)
-        for idx in range(0, pos, 2):
-            if (self.bytecode[idx] in hasjrel and 
-                self._get_full_arg(idx) + idx + 2 > pos
+        bytecode = self.bytecode
+        count = len(bytecode) // 2
+        keep = [False] * count
+        worklist = [0]
+        while worklist:
+            idx = worklist.pop()
+            while idx < count and not keep[idx]:
+                keep[idx] = True
+                op = bytecode[2*idx]
+                kind = _OPCODE_KIND[op]
+                if kind == _ARG_JABS or kind == _ARG_JREL:
+                    worklist.append(bytecode[2*idx+1] // 2)
+                if op in _NO_FALLTHROUGH:
+                    break
+                idx += 1
+
+        nop = opmap['NOP']
+        next_kept = count
+        for idx in range(count - 1, -1, -1):
+            op = bytecode[2*idx]
+            if op == nop:
+                keep[idx] = False
+            elif (
+                keep[idx] and op in _UNCONDITIONAL_JUMPS
+                and idx < bytecode[2*idx+1] // 2 <= next_kept
             ):
-                self.bytecode[idx+1] += 2
+                keep[idx] = False
+            if keep[idx]:
+                next_kept = idx
+
+        return keep
+
+    def _remove_instructions(self, keep):
+        """
+        Drop the instructions not flagged in keep, moving jumps and
+        labels that pointed at a dropped instruction to the next one
+        that is kept. Returns True if anything was dropped.
+        """
+        if all(keep):
+            return False
+
+        new_index = []
+        count = 0
+        for kept in keep:
+            new_index.append(count)
+            count += kept
+        new_index.append(count)
+
+        bytecode = []
+        bytecode_lno = []
+        for idx, kept in enumerate(keep):
+            if not kept:
+                continue
+            op = self.bytecode[2*idx]
+            arg = self.bytecode[2*idx+1]
+            kind = _OPCODE_KIND[op]
+            if kind == _ARG_JABS or kind == _ARG_JREL:
+                arg = 2 * new_index[arg // 2]
+            bytecode.append(op)
+            bytecode.append(arg)
+            bytecode_lno.append(self.bytecode_lno[idx])
+
+        self.bytecode = bytecode
+        self.bytecode_lno = bytecode_lno
+        self.targets = {
+            label: 2 * new_index[pos // 2]
+            for label, pos in self.targets.items()
+        }
+        return True
+
+    def _eliminate_dead_stores(self):
+        """
+        Replace each STORE_FAST of a value nothing reads again with a
+        POP_TOP, or drop it along with the LOAD_CONST, DUP_TOP or
+        LOAD_FAST (of a local that is always set by then) that pushed
+        the value. Dropping a load can make more stores dead, so this
+        goes on until nothing changes.
+
+        Stores to locals live in an exception handler or wherever
+        control can arrive without an explicit jump are kept.
+        """
+        store_fast = opmap['STORE_FAST']
+        load_fast = opmap['LOAD_FAST']
+        pure = (opmap['LOAD_CONST'], opmap['DUP_TOP'], load_fast)
+        nop = opmap['NOP']
+        changed = True
+        while changed:
+            flow = self._local_liveness()
+            if flow is None:
+                return
+            bytecode = self.bytecode
+            # locals that may not be set when loaded, parameters always are
+            unsafe = (
+                flow.live_in[0] & ~((1 << self.argcount) - 1) | flow.deleted
+            )
+            keep = [True] * (len(bytecode) // 2)
+            changed = False
+            for block, (start, end) in enumerate(zip(flow.starts, flow.ends)):
+                live = flow.live_out[block]
+                for idx in range(end - 1, start - 1, -1):
+                    op = bytecode[2*idx]
+                    if _OPCODE_KIND[op] != _ARG_LOCAL:
+                        continue
+                    bit = 1 << bytecode[2*idx+1]
+                    if op == store_fast and not (live | flow.pinned) & bit:
+                        prev = bytecode[2*idx-2] if idx > start else None
+                        if prev in pure and not (
+                            prev == load_fast and
+                            unsafe >> bytecode[2*idx-1] & 1
+                        ):
+                            keep[idx-1] = keep[idx] = False
+                            bytecode[2*idx-2] = bytecode[2*idx] = nop
+                        else:
+                            bytecode[2*idx] = opmap['POP_TOP']
+                            bytecode[2*idx+1] = 0
+                        changed = True
+                    elif op == store_fast:
+                        live &= ~bit
+                    else:
+                        live |= bit
+            self._remove_instructions(keep)
 
-        for idx in range(0, len(self.bytecode), 2):
-            if self.bytecode[idx] in hasjabs and self._get_full_arg(idx) > pos:
-                self.bytecode[idx+1] += 2
+    def _prune_tables(self):
+        """
+        Drop the locals, names and constants that no instruction refers
+        to, other than parameters and the docstring
+        """
+        self.varnames = self._prune_table(
+            _ARG_LOCAL, self.varnames, self.argcount
+        )
+        self.names = self._prune_table(_ARG_NAME, self.names)
+        self.consts = self._prune_table(_ARG_CONST, self.consts, 1)
 
-    def _get_full_arg(self, pos):
+    def _prune_table(self, kind, values, fixed=0):
+        """
+        The entries of an operand table that instructions of the kind
+        refer to, and the first fixed ones, with the operands renumbered
         """
-        Get the full argument value (augmented by previous EXTENDED_ARG
-        instructions) of the instruction at position pos)
+        bytecode = self.bytecode
+        used = set(range(min(fixed, len(values))))
+        for idx in range(0, len(bytecode), 2):
+            if _OPCODE_KIND[bytecode[idx]] == kind:
+                used.add(bytecode[idx+1])
+        if len(used) == len(values) or max(used, default=0) >= len(values):
+            return values
+        new_index = {}
+        kept = []
+        for idx, value in enumerate(values):
+            if idx in used:
+                new_index[idx] = len(kept)
+                kept.append(value)
+        for idx in range(0, len(bytecode), 2):
+            if _OPCODE_KIND[bytecode[idx]] == kind:
+                bytecode[idx+1] = new_index[bytecode[idx+1]]
+        return tuple(kept)
+
+    def _layout_blocks(self):
         """
-        arg = self.bytecode[pos+1]
-        mult = 1
-        while pos > 0 and self.bytecode[pos-2] == opmap['EXTENDED_ARG']:
-            mult *= 256
-            arg += self.bytecode[pos-1] * mult
-            pos -= 2
-        return arg
+        Move the cold (rarely run) basic blocks to the end of the code,
+        keeping the order of the rest, so the common path doesn't jump
+        over them. Where a block fell through into a block that is now
+        elsewhere, a POP_JUMP_IF_* ending it is inverted if its target
+        comes next, otherwise a JUMP_ABSOLUTE is added.
+
+        Without a layout profile, blocks that can only end in a raise
+        are cold. With one, blocks whose lines ran in less than 1% of
+        the calls are. The entry block stays first, and blocks holding
+        forward-only jumps other than JUMP_FORWARD aren't moved.
+
+        Instructions keep their line numbers, and an added jump takes
+        the line of the block it ends.
+        """
+        bytecode = self.bytecode
+        count = len(bytecode) // 2
+        if not count:
+            return
+        starts, ends, succs, _ = self._basic_blocks()
+        blocks = len(starts)
+        if self.layout_profile is not None:
+            cold = self._profile_cold_blocks(starts, ends)
+        else:
+            cold = self._raising_blocks(starts, ends, succs)
+        jump_forward = opmap['JUMP_FORWARD']
+        for block in range(blocks):
+            if not cold[block]:
+                continue
+            for idx in range(starts[block], ends[block]):
+                op = bytecode[2*idx]
+                if _OPCODE_KIND[op] == _ARG_JREL and op != jump_forward:
+                    cold[block] = False
+                    break
+        cold[0] = False
+        order = [block for block in range(blocks) if not cold[block]]
+        order.extend(block for block in range(blocks) if cold[block])
+        if order == list(range(blocks)):
+            return
+
+        jump_absolute = opmap['JUMP_ABSOLUTE']
+        new_index = [0] * (count + 1)
+        new_bytecode = []
+        new_lno = []
+        # (position of the argument, original target instruction)
+        jumps = []
+        for pos, block in enumerate(order):
+            start, end = starts[block], ends[block]
+            for idx in range(start, end):
+                new_index[idx] = len(new_lno)
+                op = bytecode[2*idx]
+                arg = bytecode[2*idx+1]
+                kind = _OPCODE_KIND[op]
+                if kind == _ARG_JABS or kind == _ARG_JREL:
+                    if op == jump_forward:
+                        op = jump_absolute
+                    jumps.append((len(new_bytecode) + 1, arg // 2))
+                new_bytecode.append(op)
+                new_bytecode.append(arg)
+                new_lno.append(self.bytecode_lno[idx])
+
+            last = bytecode[2*end-2]
+            if last in _NO_FALLTHROUGH or end >= count:
+                continue
+            follow = order[pos+1] if pos + 1 < len(order) else None
+            if follow == block + 1:
+                continue
+            target = bytecode[2*end-1] // 2
+            if last in _INVERTED_JUMPS and follow is not None and (
+                target == starts[follow]
+            ):
+                new_bytecode[-2] = _INVERTED_JUMPS[last]
+                jumps[-1] = (len(new_bytecode) - 1, end)
+            else:
+                jumps.append((len(new_bytecode) + 1, end))
+                new_bytecode.append(jump_absolute)
+                new_bytecode.append(0)
+                # the line of the block the jump ends
+                new_lno.append(new_lno[-1])
+        new_index[count] = len(new_lno)
+
+        for pos, target in jumps:
+            new_bytecode[pos] = 2 * new_index[min(target, count)]
+        self.bytecode = new_bytecode
+        self.bytecode_lno = new_lno
+        self.targets = {
+            label: 2 * new_index[min(pos // 2, count)]
+            for label, pos in self.targets.items()
+        }
+
+    def _raising_blocks(self, starts, ends, succs):
+        """
+        Flag the blocks ending in a RAISE_VARARGS, and those that can
+        only go on to such blocks
+        """
+        raise_varargs = opmap['RAISE_VARARGS']
+        cold = [
+            self.bytecode[2*end-2] == raise_varargs for end in ends
+        ]
+        changed = True
+        while changed:
+            changed = False
+            for block in range(len(starts) - 1, -1, -1):
+                if not cold[block] and succs[block] and all(
+                    cold[succ] for succ in succs[block]
+                ):
+                    cold[block] = True
+                    changed = True
+        return cold
+
+    def _profile_cold_blocks(self, starts, ends):
+        """
+        Flag the blocks that ran in less than _COLD_FRACTION of the
+        calls according to the layout profile, taking the count of a
+        block as the highest count of its source lines. Nothing is cold
+        if the entry block has no count.
+        """
+        offset = self.fl + self.lnodoc + 1
+        profile = self.layout_profile
+        counts = []
+        for start, end in zip(starts, ends):
+            counts.append(max(
+                (
+                    profile.get(lno + offset, 0)
+                    for lno in self.bytecode_lno[start:end] if lno
+                ),
+                default=0
+            ))
+        calls = counts[0]
+        return [count < calls * _COLD_FRACTION for count in counts]
+
+    def _basic_blocks(self):
+        """
+        Split the resolved bytecode into basic blocks. Returns the
+        start and end instruction of each block, the blocks each one
+        can go to next (by its jump, then by falling through) and the
+        set of instructions that control can reach without an explicit
+        jump, see _IMPLICIT_TARGETS.
+        """
+        bytecode = self.bytecode
+        count = len(bytecode) // 2
+        leaders = {0}
+        implicit = set()
+        for idx in range(count):
+            op = bytecode[2*idx]
+            kind = _OPCODE_KIND[op]
+            if kind == _ARG_JABS or kind == _ARG_JREL:
+                target = bytecode[2*idx+1] // 2
+                leaders.add(target)
+                leaders.add(idx + 1)
+                if op in _IMPLICIT_TARGETS and target < count:
+                    implicit.add(target)
+            elif op in _NO_FALLTHROUGH:
+                leaders.add(idx + 1)
+        starts = sorted(idx for idx in leaders if idx < count)
+        ends = starts[1:] + [count]
+        block_of = {start: block for block, start in enumerate(starts)}
+
+        succs = []
+        for end in ends:
+            op = bytecode[2*end-2]
+            kind = _OPCODE_KIND[op]
+            succ = []
+            if kind == _ARG_JABS or kind == _ARG_JREL:
+                target = bytecode[2*end-1] // 2
+                if target < count:
+                    succ.append(block_of[target])
+            if op not in _NO_FALLTHROUGH and end < count:
+                succ.append(block_of[end])
+            succs.append(succ)
+        return starts, ends, succs, implicit
+
+    def _local_liveness(self):
+        """
+        Liveness of the locals over the basic blocks of the resolved
+        bytecode, as bit masks of local indices. Returns a _Liveness,
+        or None if there is no code or it refers to undeclared locals.
+
+        Control arriving without an explicit jump (at an exception
+        handler, or the end of a loop left by BREAK_LOOP) isn't
+        followed, instead the locals live there are flagged as pinned.
+        """
+        bytecode = self.bytecode
+        count = len(bytecode) // 2
+        nlocals = len(self.varnames)
+        if not count:
+            return None
+        for idx in range(0, len(bytecode), 2):
+            if _OPCODE_KIND[bytecode[idx]] == _ARG_LOCAL and (
+                bytecode[idx+1] >= nlocals
+            ):
+                return None
+
+        load_fast = opmap['LOAD_FAST']
+        store_fast = opmap['STORE_FAST']
+        delete_fast = opmap['DELETE_FAST']
+        starts, ends, succs, implicit = self._basic_blocks()
+        block_of = {start: block for block, start in enumerate(starts)}
+
+        uses = []
+        defs = []
+        deleted = 0
+        for start, end in zip(starts, ends):
+            use = 0
+            define = 0
+            for idx in range(start, end):
+                op = bytecode[2*idx]
+                if op == load_fast or op == delete_fast:
+                    bit = 1 << bytecode[2*idx+1]
+                    if not define & bit:
+                        use |= bit
+                    if op == delete_fast:
+                        define |= bit
+                        deleted |= bit
+                elif op == store_fast:
+                    define |= 1 << bytecode[2*idx+1]
+            uses.append(use)
+            defs.append(define)
+
+        blocks = len(starts)
+        live_in = list(uses)
+        live_out = [0] * blocks
+        changed = True
+        while changed:
+            changed = False
+            for block in range(blocks - 1, -1, -1):
+                out = 0
+                for succ in succs[block]:
+                    out |= live_in[succ]
+                if out != live_out[block]:
+                    live_out[block] = out
+                    live_in[block] = uses[block] | (out & ~defs[block])
+                    changed = True
+
+        pinned = 0
+        for target in implicit:
+            pinned |= live_in[block_of[target]]
+        return _Liveness(starts, ends, live_in, live_out, pinned, deleted)
+
+    def _compact_locals(self):
+        """
+        Let locals that are never live at the same time share a slot of
+        the frame. Parameters keep their slots, as do locals that can be
+        read before they are set (so they still raise UnboundLocalError)
+        and the locals pinned by _local_liveness.
+
+        A shared slot takes the name of the first local in it.
+        """
+        varnames = self.varnames
+        argcount = self.argcount
+        if len(varnames) - argcount < 2:
+            return
+        flow = self._local_liveness()
+        if flow is None:
+            return
+
+        bytecode = self.bytecode
+        load_fast = opmap['LOAD_FAST']
+        store_fast = opmap['STORE_FAST']
+        delete_fast = opmap['DELETE_FAST']
+        pinned = flow.pinned | flow.live_in[0] | ((1 << argcount) - 1)
+
+        # a local interferes with everything live where it is set
+        interfere = [0] * len(varnames)
+        for block, (start, end) in enumerate(zip(flow.starts, flow.ends)):
+            live = flow.live_out[block]
+            for idx in range(end - 1, start - 1, -1):
+                op = bytecode[2*idx]
+                if op == store_fast or op == delete_fast:
+                    var = bytecode[2*idx+1]
+                    bit = 1 << var
+                    interfere[var] |= live & ~bit
+                    if op == store_fast:
+                        live &= ~bit
+                    else:
+                        live |= bit
+                elif op == load_fast:
+                    live |= 1 << bytecode[2*idx+1]
+        for var, mask in enumerate(interfere):
+            while mask:
+                low = mask & -mask
+                interfere[low.bit_length() - 1] |= 1 << var
+                mask ^= low
+
+        # first fit, in order of declaration
+        slot_of = list(range(len(varnames)))
+        members = []
+        shared = False
+        for var in range(argcount, len(varnames)):
+            if pinned >> var & 1:
+                continue
+            for slot, mask in enumerate(members):
+                if not interfere[var] & mask:
+                    members[slot] |= 1 << var
+                    slot_of[var] = -1 - slot
+                    shared = True
+                    break
+            else:
+                members.append(1 << var)
+                slot_of[var] = -len(members)
+        if not shared:
+            return
+
+        new_index = list(range(argcount))
+        names = list(varnames[:argcount])
+        placed = {}
+        for var in range(argcount, len(varnames)):
+            slot = slot_of[var]
+            if slot >= 0:
+                new_index.append(len(names))
+                names.append(varnames[var])
+            elif slot in placed:
+                new_index.append(placed[slot])
+            else:
+                placed[slot] = len(names)
+                new_index.append(len(names))
+                names.append(varnames[var])
+
+        for idx in range(0, len(bytecode), 2):
+            if _OPCODE_KIND[bytecode[idx]] == _ARG_LOCAL:
+                bytecode[idx+1] = new_index[bytecode[idx+1]]
+        self.varnames = tuple(names)
+
+    def _relax_arguments(self):
+        """
+        Size the EXTENDED_ARG prefix of every instruction and lay out
+        the final bytecode, with jump arguments pointing at the
+        relocated targets.
+
+        Jumps start out with no prefix and are only ever grown, so each
+        sweep over the jumps either settles or grows at least one prefix
+        (at most 3 times per jump). In practice this takes two or
+        three linear sweeps.
+        """
+        ops = self.bytecode[0::2]
+        args = self.bytecode[1::2]
+        sizes = [0 if arg < 256 else _extended_count(arg) for arg in args]
+        jumps = []
+        for idx, op in enumerate(ops):
+            kind = _OPCODE_KIND[op]
+            if kind == _ARG_JABS or kind == _ARG_JREL:
+                jumps.append((idx, args[idx] // 2, kind == _ARG_JREL))
+                sizes[idx] = 0
+
+        changed = True
+        while changed:
+            offsets = [0]
+            offsets.extend(accumulate(2 * size + 2 for size in sizes))
+
+            changed = False
+            for idx, target, relative in jumps:
+                arg = offsets[target]
+                if relative:
+                    arg -= offsets[idx + 1]
+                args[idx] = arg
+                if arg > 255:
+                    size = _extended_count(arg)
+                    if size > sizes[idx]:
+                        sizes[idx] = size
+                        changed = True
+
+        if not any(sizes):
+            self.bytecode[1::2] = args
+            return
+
+        bytecode = []
+        bytecode_lno = []
+        extended_arg = opmap['EXTENDED_ARG']
+        for op, arg, size, lno in zip(ops, args, sizes, self.bytecode_lno):
+            for shift in range(8 * size, 0, -8):
+                bytecode.append(extended_arg)
+                bytecode.append((arg >> shift) & 0xff)
+                bytecode_lno.append(0)
+            bytecode.append(op)
+            bytecode.append(arg & 0xff)
+            bytecode_lno.append(lno)
+
+        self.bytecode = bytecode
+        self.bytecode_lno = bytecode_lno
 
     def assemble_lnotab(self):
         """
         This is a hot mess
+
+        One entry per instruction, the EXTENDED_ARG prefixes (line 0)
+        counting with the instruction they prefix. Large line jumps
+        are split as CPython does, the address increment going with
+        the first part.
         """
         lnotab = []
-        current = 0
-        dist = 2
-        last_entry = 0
+        offset = 0
+        start = None
+        last_offset = 0
+        last_line = 0
         for entry in self.bytecode_lno:
+            # an instruction's line starts at its first EXTENDED_ARG
+            if start is None:
+                start = offset
+            offset += 2
             if entry == 0:
-                dist += 2
                 continue
-            entry += self.lnodoc + 1
-            more_entry = 0
-            while entry - last_entry > 127:
-                lnotab.append(0)
-                lnotab.append(127)
-                entry -= 127; more_entry += 127
-            lnotab.append(current)
-            lnotab.append(entry - last_entry)
-            last_entry = entry + more_entry
-            current = dist
-            dist = 2
+            line = entry + self.lnodoc + 1
+            d_offset = start - last_offset
+            d_line = line - last_line
+            while d_offset > 255:
+                lnotab += (255, 0)
+                d_offset -= 255
+            # line increments are signed bytes, lines can go backwards
+            # as in repeated blocks
+            while d_line > 127:
+                lnotab += (d_offset, 127)
+                d_offset = 0
+                d_line -= 127
+            while d_line < -128:
+                lnotab += (d_offset, 0x80)
+                d_offset = 0
+                d_line += 128
+            lnotab += (d_offset, d_line & 0xff)
+            last_offset = start
+            last_line = line
+            start = None
 
         self.lnotab = bytes(lnotab)
+        if self.stats is not None:
+            self.stats.lnotab_size = len(self.lnotab)
 
 
-def dis(func):
+class _Macro:
     """
-    Disassemble a function into cpython_assembly format
+    A ``.macro`` definition: its parameters and the tokens of its body.
+    The body with the arguments substituted is cached for each distinct
+    set of arguments.
     """
-    co = func.__code__
-    result = []
+    def __init__(self, name, params, body):
+        self.name = name
+        self.params = params
+        self.body = body
+        self.expanded = {}
 
-    if func.__doc__:
-        for line in func.__doc__.splitlines():
-            result.append(line)
-    result.append('    :::asm')
+    def expand(self, call):
+        """
+        Body tokens for a call, an op token with the arguments
+        (comma separated) as arg
+        """
+        args = call.arg
+        body = self.expanded.get(args)
+        if body is not None:
+            return body
 
-    result.append('    .stacksize {0}'.format(co.co_stacksize))
-    flags = []
-    for key in CO_FLAGS:
-        if co.co_flags & CO_FLAGS[key]:
-            flags.append(key.lower())
-    result.append('    .flags {0}'.format(', '.join(flags)))
+        values = [a.strip() for a in args.split(',')] if args else []
+        if len(values) != len(self.params):
+            raise ValueError(
+                'line {0}: macro {1} takes {2} arguments, {3} given'.format(
+                    call.lno, self.name, len(self.params), len(values)
+                )
+            )
+        values = dict(zip(self.params, values))
+        body = [
+            token._replace(arg=values[token.arg])
+            if token.kind == 'op' and token.arg in values else token
+            for token in self.body
+        ]
+        self.expanded[args] = body
+        return body
 
-    result.append('    .code')
-    for inst in get_instructions(func):
-        if inst.is_jump_target:
-            result.append('    t{0}:'.format(inst.offset))
-        if inst.opcode in hasjabs or inst.opcode in hasjrel:
-            arg = 't{0}'.format(inst.argval)
-            comment = ''
-        elif inst.arg is not None:
-            arg = inst.arg % 256
-            comment = '; ({0})'.format(inst.argrepr)
-        else:
-            arg = ''
-            comment = ''
 
-        result.append(
-            '      {0: <25} {1} {2}'.format(inst.opname, arg, comment)
+def max_stack_depth(code):
+    """
+    Compute the maximum stack depth of bytecode by walking its control
+    flow graph from a worklist. An instruction is only walked again if
+    a forward jump reaches it with a deeper stack than before. Back-edges
+    are only followed to instructions not seen yet, like the compiler's
+    b_seen, since the overestimated handler effects would otherwise make
+    every trip round a loop with a try or with block arrive deeper.
+    """
+    count = len(code) // 2
+    args = [0] * count
+    ext = 0
+    for idx in range(count):
+        arg = code[2*idx+1] | ext
+        ext = arg << 8 if code[2*idx] == opmap['EXTENDED_ARG'] else 0
+        args[idx] = arg
+
+    depths = [-1] * count
+    maxdepth = 0
+    worklist = [(0, 0)]
+    while worklist:
+        idx, depth = worklist.pop()
+        while idx < count and depth > depths[idx]:
+            depths[idx] = depth
+            op = code[2*idx]
+            kind = _OPCODE_KIND[op]
+            fall, jump = _branch_effects(op, args[idx])
+            if jump is not None:
+                if kind == _ARG_JABS:
+                    target = args[idx] // 2
+                else:
+                    target = idx + 1 + args[idx] // 2
+                if target > idx or depths[target] < 0:
+                    worklist.append((target, depth + jump))
+                maxdepth = max(maxdepth, depth + jump)
+            depth += fall
+            maxdepth = max(maxdepth, depth)
+            if op in _NO_FALLTHROUGH:
+                break
+            idx += 1
+
+    return maxdepth
+
+
+def _branch_effects(op, arg):
+    """
+    Stack effect of an instruction when execution falls through to
+    the next instruction and when it jumps (None if it can't jump)
+    """
+    if op in _BRANCH_EFFECTS:
+        return _BRANCH_EFFECTS[op]
+    if op in _NO_STACK_EFFECT:
+        return 0, None
+    effect = stack_effect(op, arg if op >= HAVE_ARGUMENT else None)
+    if _OPCODE_KIND[op] in (_ARG_JABS, _ARG_JREL):
+        return effect, effect
+    return effect, None
+
+
+def _split_const(line):
+    """
+    Split a line of the consts section into its alias (or None)
+    and expression
+    """
+    alias, sep, expr = line.partition('=')
+    alias = alias.strip()
+    if sep and alias.isidentifier() and not expr.startswith('='):
+        return alias, expr.strip()
+    return None, line.strip()
+
+
+@lru_cache(maxsize=4096)
+def _parse_const(expr):
+    """
+    Parse a constant expression, returning ``(True, value)`` for a
+    literal of an immutable builtin type and ``(False, code)`` with the
+    expression compiled for eval otherwise
+    """
+    try:
+        value = ast.literal_eval(expr)
+    except (ValueError, TypeError, SyntaxError):
+        pass
+    else:
+        if _foldable(value):
+            return True, value
+    return False, compile(expr, '<consts>', 'eval')
+
+
+def _fold(op, values, arg=0):
+    """
+    Compute the result of a foldable operation on constant values, with
+    the argument of the instruction for COMPARE_OP.
+    Raises ValueError if the values or the result are not worth
+    folding, or whatever the operation itself raises.
+    """
+    if not all(_foldable(value) for value in values):
+        raise ValueError('not a foldable constant')
+
+    if op == opmap['BUILD_TUPLE']:
+        result = tuple(values)
+    elif op == opmap['COMPARE_OP']:
+        result = _COMPARE_FOLDS[arg](*values)
+    elif op in _UNARY_FOLDS:
+        result = _UNARY_FOLDS[op](*values)
+    else:
+        _check_fold_size(op, *values)
+        result = _BINARY_FOLDS[op](*values)
+
+    if isinstance(result, (str, bytes, tuple, frozenset)):
+        if len(result) > _MAX_FOLD_SIZE:
+            raise ValueError('folded constant is too long')
+    return result
+
+
+def _foldable(value):
+    """
+    Only fold builtin immutable values, where the operations are pure
+    """
+    if isinstance(value, (tuple, frozenset)):
+        return type(value) in (tuple, frozenset) and all(
+            _foldable(item) for item in value
         )
-    return '\n'.join(result)
+    return type(value) in _FOLDABLE_TYPES
+
+
+def _check_fold_size(op, left, right):
+    """
+    Refuse to fold operations that would build huge ints or sequences
+    before computing them
+    """
+    if op == opmap['BINARY_MODULO'] and isinstance(left, (str, bytes)):
+        # the width of a format can be anything, as in '%999999999d'
+        raise ValueError('string formatting is not folded')
+    ints = isinstance(left, int) and isinstance(right, int)
+    if op == opmap['BINARY_POWER'] and ints and right > 0:
+        bits = left.bit_length() * right
+    elif op == opmap['BINARY_LSHIFT'] and ints and right > 0:
+        bits = left.bit_length() + right
+    elif op == opmap['BINARY_MULTIPLY'] and ints:
+        bits = left.bit_length() + right.bit_length()
+    elif op == opmap['BINARY_MULTIPLY']:
+        if isinstance(right, (str, bytes, tuple)):
+            left, right = right, left
+        if isinstance(left, (str, bytes, tuple)) and isinstance(right, int):
+            if len(left) * right > _MAX_FOLD_SIZE:
+                raise ValueError('folded constant is too long')
+        return
+    else:
+        return
+
+    if bits > _MAX_FOLD_INT_BITS:
+        raise ValueError('folded constant is too large')
+
+
+def _index_table(names, start=0):
+    """
+    Map each name to its (first) index, offset by start
+    """
+    table = {}
+    for idx, name in enumerate(names, start):
+        table.setdefault(name, idx)
+    return table
+
+
+def _extended_count(arg):
+    """
+    Number of EXTENDED_ARG prefixes needed to encode arg
+    """
+    count = 0
+    while arg > 255:
+        arg >>= 8
+        count += 1
+    return count
+
+
+def dis(func, file=None):
+    """
+    Disassemble a function (or code object) into cpython_assembly
+    format. Operands are symbolic, so the listing reassembles to the
+    same code: constants with a literal form are written out and the
+    others are taken from ``args``, in order, with their repr in a
+    comment.
+
+    Returns the listing, or writes it to file line by line if given.
+    """
+    co, doc = _code_and_doc(func)
+    lines = _dis_lines(co, doc)
+    if file is None:
+        return '\n'.join(lines)
+    for line in lines:
+        file.write(line)
+        file.write('\n')
+
+
+def _code_and_doc(func):
+    """
+    The code of a function or code object and its docstring, or None
+    if the first constant of the code is not a docstring. Functions
+    without a docstring have None there, which is an ordinary constant.
+    """
+    if not isinstance(func, types.CodeType):
+        co = func.__code__
+    else:
+        co = func
+        if not (co.co_flags & CO_FLAGS['OPTIMIZED']) or (
+            co.co_name.startswith('<') and co.co_name != '<lambda>'
+        ):
+            return co, None
+    doc = co.co_consts[0] if co.co_consts else None
+    return co, doc if isinstance(doc, str) else None
+
+
+def _dis_lines(co, doc, params=False):
+    yield from _dis_header(co, doc, params)
+    for _, line in _dis_code(co, doc):
+        yield line
+
+
+def _dis_header(co, doc, params=False):
+    """
+    Yield the docstring and directives of a dis listing, up to the
+    code
+    """
+    if doc:
+        yield from doc.splitlines()
+    yield '    :::asm'
+    yield from _dis_directives(co, doc, params)
+
+
+def _dis_directives(co, doc, params=False):
+    """
+    Yield the directives of a dis listing, up to the code. Parameters
+    are left to the function the listing is put in unless params is
+    set.
+    """
+    yield '    .stacksize {0}'.format(co.co_stacksize)
+    flags = [key.lower() for key in CO_FLAGS if co.co_flags & CO_FLAGS[key]]
+    yield '    .flags {0}'.format(', '.join(flags))
+
+    nparams = co.co_argcount + co.co_kwonlyargcount
+    nparams += bool(co.co_flags & CO_FLAGS['VARARGS'])
+    nparams += bool(co.co_flags & CO_FLAGS['VARKEYWORDS'])
+    if params and nparams:
+        yield '    .params {0}'.format(', '.join(co.co_varnames[:nparams]))
+    for directive, names in (
+        ('locals', co.co_varnames[nparams:]),
+        ('names', co.co_names),
+        ('freevars', co.co_freevars),
+        ('cellvars', co.co_cellvars),
+    ):
+        if names:
+            yield '    .{0} {1}'.format(directive, ', '.join(names))
+
+    consts = co.co_consts
+    if doc is not None:
+        consts = consts[1:]
+    if consts:
+        yield '    .consts'
+    nargs = 0
+    for idx, alias in enumerate(_const_aliases(co, doc)):
+        if idx == 0 and doc is not None:
+            continue
+        value = co.co_consts[idx]
+        literal = _const_literal(value)
+        if literal is not None:
+            yield '      {0} = {1}'.format(alias, literal)
+        else:
+            yield '      {0} = args[{1}]  ; {2}'.format(
+                alias, nargs, repr(value).replace('\n', ' ')
+            )
+            nargs += 1
+
+    yield '    .code'
+
+
+def _const_aliases(co, doc):
+    aliases = ['c{0}'.format(idx) for idx in range(len(co.co_consts))]
+    if doc is not None and aliases:
+        aliases[0] = '__doc__'
+    return aliases
+
+
+def _const_literal(value):
+    """
+    Source for a constant that the consts section parses back to the
+    same value, or None. Semicolons start a comment in asm source, so
+    they are escaped in strings.
+    """
+    if not _foldable(value):
+        return None
+    text = repr(value)
+    try:
+        parsed = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return None
+    if _const_key(parsed) != _const_key(value):
+        return None
+    return text.replace(';', '\\x3b')
+
+
+def _symbols(names):
+    """
+    Operand for each index of a table of names: the name, or the index
+    itself where an earlier entry has the same name
+    """
+    first = _index_table(names)
+    return [
+        name if first[name] == idx else str(idx)
+        for idx, name in enumerate(names)
+    ]
+
+
+# dis listing lines start with the padded opname
+_DIS_OPNAMES = ['      {0: <25} '.format(name) for name in opname]
+
+
+def _dis_code(co, doc=None):
+    """
+    Yield (offset, line) for each line of the code section of a dis
+    listing, with an offset of None for labels. doc is None if the
+    first constant is not a docstring.
+
+    co_code is decoded in place, EXTENDED_ARG prefixes are folded into
+    the argument of the instruction they prefix (whose offset is that
+    of its first prefix) and left to the assembler to put back.
+    """
+    code = memoryview(co.co_code)
+    size = len(code)
+    kinds = _OPCODE_KIND
+    extended_arg = opmap['EXTENDED_ARG']
+
+    targets = set()
+    ext = 0
+    for idx in range(0, size, 2):
+        op = code[idx]
+        arg = ext | code[idx+1]
+        if op == extended_arg:
+            ext = arg << 8
+            continue
+        ext = 0
+        kind = kinds[op]
+        if kind == _ARG_JABS:
+            targets.add(arg)
+        elif kind == _ARG_JREL:
+            targets.add(idx + 2 + arg)
+
+    tables = [None] * len(_ARG_KINDS)
+    tables[_ARG_LOCAL] = _symbols(co.co_varnames)
+    tables[_ARG_NAME] = _symbols(co.co_names)
+    tables[_ARG_CONST] = _const_aliases(co, doc)
+    tables[_ARG_FREE] = _symbols(co.co_cellvars + co.co_freevars)
+    opnames = _DIS_OPNAMES
+
+    ext = 0
+    start = 0
+    for idx in range(0, size, 2):
+        op = code[idx]
+        arg = ext | code[idx+1]
+        if op == extended_arg:
+            ext = arg << 8
+            continue
+        ext = 0
+        if start in targets:
+            yield None, '    t{0}:'.format(start)
+        if idx != start and idx in targets:
+            yield None, '    t{0}:'.format(idx)
+
+        if op < HAVE_ARGUMENT:
+            line = opnames[op].rstrip()
+        else:
+            kind = kinds[op]
+            if kind == _ARG_JABS:
+                operand = 't{0}'.format(arg)
+            elif kind == _ARG_JREL:
+                operand = 't{0}'.format(idx + 2 + arg)
+            elif kind == _ARG_NONE:
+                operand = arg
+            else:
+                table = tables[kind]
+                operand = table[arg] if arg < len(table) else arg
+            line = '{0}{1}'.format(opnames[op], operand)
+        yield start, line
+        start = idx + 2
@@ -0,0 +1,251 @@
+"""
+Ahead of time assembly: write .pyc files for modules using asm with the
+assembled code objects already in place, so importing them doesn't run
+the assembler at all
+"""
+from collections import Counter
+from importlib.util import MAGIC_NUMBER, cache_from_source
+import importlib
+import marshal
+import os
+import sys
+import types
+
+from cpython_assembly import asm
+from cpython_assembly._batch import (
+    map_safely, module_name, nested_qualname, python_files, walk_code
+)
+
+# Added to the module code of prebuilt .pyc files so they can be told
+# apart from the .pyc files the import system writes, followed by the
+# digest of the assembler that built them, and to the code of each
+# prebuilt function for the decorator to pass it through
+PREBUILT_MARKER = asm.PREBUILT_MARKER
+
+
+def build(paths, max_workers=None, force=False):
+    """
+    Prebuild every module using asm under the given files and
+    directories, in parallel in a process pool. Modules whose .pyc is
+    a prebuilt one for the current source are skipped unless force is
+    set.
+
+    Returns a list of ``(path, result)`` where result is the number
+    of functions prebuilt, None if the module was up to date, or the
+    exception raised while building it.
+    """
+    files = list(find_sources(paths))
+    results = map_safely(
+        build_file, [(path, force) for path in files], max_workers
+    )
+    return list(zip(files, results))
+
+
+def find_sources(paths):
+    """
+    Yield the python files under the given files and directories
+    that contain asm source
+    """
+    for path in python_files(paths):
+        with open(path, 'rb') as fp:
+            if b':::asm' in fp.read():
+                yield path
+
+
+def build_file(path, force=False):
+    """
+    Import a module, and write its .pyc with the code objects of the
+    assembled functions in place of the ones compiled from the source.
+    Returns the number of functions prebuilt, or None if the .pyc was
+    already prebuilt for the current source.
+
+    Only functions reachable from the module namespace (including
+    classes) can be found, others are still assembled on import. They
+    are matched up with the compiled code by qualname, so functions
+    sharing a qualname in the module aren't prebuilt either.
+    """
+    path = os.path.abspath(path)
+    source_stat = os.stat(path)
+    pyc = cache_from_source(path)
+    header = _pyc_header(source_stat)
+    if not force and _is_prebuilt(pyc, header):
+        return None
+
+    # import from the source, not from a stale prebuilt .pyc
+    try:
+        os.unlink(pyc)
+    except OSError:
+        pass
+    module = _import_path(path)
+    asm.assemble_module(module, max_workers=1)
+    assembled = {}
+    _collect_assembled(vars(module), module, '', assembled, set())
+
+    with open(path, 'rb') as fp:
+        source = fp.read()
+    code = compile(source, path, 'exec', dont_inherit=True)
+    counts = Counter(
+        qualname for qualname, co in walk_code(code) if _has_asm(co)
+    )
+    for qualname, count in counts.items():
+        if count > 1:
+            assembled.pop(qualname, None)
+    replaced = []
+    code = _replace_code(code, '<module>', assembled, replaced)
+    code = _with_consts(
+        code, code.co_consts + (PREBUILT_MARKER, asm._assembler_digest())
+    )
+
+    _write_atomic(pyc, header + marshal.dumps(code))
+    return len(replaced)
+
+
+def _pyc_header(source_stat):
+    """
+    Timestamp based .pyc header for a source file
+    """
+    mtime = int(source_stat.st_mtime) & 0xFFFFFFFF
+    size = source_stat.st_size & 0xFFFFFFFF
+    header = MAGIC_NUMBER
+    if sys.version_info >= (3, 7):
+        # flags, for a timestamp based .pyc
+        header += (0).to_bytes(4, 'little')
+    return header + mtime.to_bytes(4, 'little') + size.to_bytes(4, 'little')
+
+
+def _is_prebuilt(pyc, header):
+    """
+    Check whether pyc is a prebuilt .pyc matching the header, built by
+    this version of the assembler
+    """
+    try:
+        with open(pyc, 'rb') as fp:
+            data = fp.read()
+    except OSError:
+        return False
+    if not data.startswith(header):
+        return False
+    try:
+        code = marshal.loads(data[len(header):])
+    except (EOFError, ValueError, TypeError):
+        return False
+    return code.co_consts[-2:] == (PREBUILT_MARKER, asm._assembler_digest())
+
+
+def _import_path(path):
+    """
+    Import the module at path under its full dotted name, with the
+    directory above its top level package on sys.path
+    """
+    root, name = module_name(path)
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    return importlib.import_module(name)
+
+
+def _collect_assembled(namespace, module, prefix, assembled, seen):
+    """
+    Find the assembled functions of a module, and of the classes in
+    it, by qualname. Code with bound globals is left out, the bound
+    objects have to be looked up on import.
+
+    Code with free variables is found as is, under the name it is bound
+    to. Assembled code gets the name and filename of the original
+    function the other way around, so its name is the module's file.
+    """
+    for key, value in list(namespace.items()):
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        if isinstance(value, types.CodeType):
+            code = value
+            qualname = prefix + key
+            if code.co_name != module.__file__:
+                continue
+        elif getattr(value, '__module__', None) != module.__name__:
+            continue
+        elif isinstance(value, type):
+            _collect_assembled(
+                vars(value), module, value.__qualname__ + '.', assembled,
+                seen
+            )
+            continue
+        else:
+            code = getattr(value, '__code__', None)
+            qualname = getattr(value, '__qualname__', None)
+        if (
+            isinstance(code, types.CodeType) and _is_assembled(code)
+            and not asm._has_bound_globals(code)
+        ):
+            assembled[qualname] = code
+
+
+def _is_assembled(code):
+    doc = code.co_consts[0] if code.co_consts else None
+    return isinstance(doc, str) and ':::asm' not in doc
+
+
+def _has_asm(code):
+    doc = code.co_consts[0] if code.co_consts else None
+    return isinstance(doc, str) and ':::asm' in doc
+
+
+def _replace_code(code, qualname, assembled, replaced):
+    """
+    Rebuild a compiled code object with each nested function whose
+    docstring holds asm source swapped for its assembled code
+    """
+    consts = []
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            name = nested_qualname(code, qualname, const)
+            if _has_asm(const) and name in assembled:
+                const = assembled[name]
+                if const.co_consts[-1:] != (PREBUILT_MARKER,):
+                    const = _with_consts(
+                        const, const.co_consts + (PREBUILT_MARKER,)
+                    )
+                replaced.append(const)
+            else:
+                const = _replace_code(const, name, assembled, replaced)
+        consts.append(const)
+    return _with_consts(code, tuple(consts))
+
+
+def _with_consts(code, consts):
+    return types.CodeType(
+        code.co_argcount,
+        code.co_kwonlyargcount,
+        code.co_nlocals,
+        code.co_stacksize,
+        code.co_flags,
+        code.co_code,
+        consts,
+        code.co_names,
+        code.co_varnames,
+        code.co_filename,
+        code.co_name,
+        code.co_firstlineno,
+        code.co_lnotab,
+        code.co_freevars,
+        code.co_cellvars
+    )
+
+
+def _write_atomic(path, data):
+    """
+    Write under a temporary name and move into place, so that an import
+    running alongside never reads a partial file
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{0}.{1}'.format(path, os.getpid())
+    try:
+        with open(tmp, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
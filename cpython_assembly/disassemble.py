@@ -0,0 +1,100 @@
+"""
+Bulk disassembly: write asm listings of every function in a package,
+including nested functions, class bodies and module code, with a process
+pool working on the modules in parallel
+"""
+import importlib.util
+import os
+import re
+
+from cpython_assembly import asm
+from cpython_assembly._batch import (
+    map_safely, module_name, python_files, walk_code
+)
+
+INDEX_NAME = 'index.txt'
+
+
+def disassemble(paths, output, max_workers=None):
+    """
+    Disassemble the modules under the given files, directories or
+    module names into one ``<module>.asm`` file each in the output
+    directory, and write an index of the instruction count of every
+    code object to ``index.txt`` there.
+
+    Returns a list of ``(path, result)`` where result is a list of
+    ``(qualname, first line, instruction count)`` for each code object
+    in the module, or the exception raised while disassembling it.
+    """
+    modules = list(find_modules(paths))
+    os.makedirs(output, exist_ok=True)
+    jobs = [
+        (path, name, os.path.join(output, name + '.asm'))
+        for path, name in modules
+    ]
+    results = map_safely(disassemble_file, jobs, max_workers)
+
+    with open(os.path.join(output, INDEX_NAME), 'w') as fp:
+        for (_, name), result in zip(modules, results):
+            if isinstance(result, Exception):
+                continue
+            for qualname, lineno, count in result:
+                fp.write('{0:>10}  {1}:{2}  line {3}\n'.format(
+                    count, name, qualname, lineno
+                ))
+    return [(path, result) for (path, _), result in zip(modules, results)]
+
+
+def find_modules(paths):
+    """
+    Yield ``(path, module name)`` for the python files under the given
+    files and directories. Anything else is taken as the name of a
+    module or package to find on sys.path.
+    """
+    paths = [
+        path if os.path.exists(path) else _find_module(path)
+        for path in paths
+    ]
+    for path in python_files(paths):
+        yield path, module_name(path)[1]
+
+
+def _find_module(name):
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError('No module named {0!r}'.format(name))
+    if spec.submodule_search_locations:
+        return list(spec.submodule_search_locations)[0]
+    return spec.origin
+
+
+def disassemble_file(path, name, out_path):
+    """
+    Compile a python file without importing it and write the listing
+    of each of its code objects to out_path, streaming it line by line.
+    Returns ``(qualname, first line, instruction count)`` for each.
+    """
+    with open(path, 'rb') as fp:
+        source = fp.read()
+    code = compile(source, path, 'exec', dont_inherit=True)
+
+    summary = []
+    with open(out_path, 'w') as fp:
+        for qualname, co in walk_code(code):
+            fp.write('; {0}:{1}  line {2}\n'.format(
+                name, qualname, co.co_firstlineno
+            ))
+            fp.write('.function {0}\n'.format(re.sub(r'\W', '_', qualname)))
+            doc = asm._code_and_doc(co)[1]
+            for line in asm._dis_directives(co, doc, params=True):
+                fp.write(line)
+                fp.write('\n')
+            count = 0
+            for offset, line in asm._dis_code(co, doc):
+                if offset is not None:
+                    count += 1
+                fp.write(line)
+                fp.write('\n')
+            fp.write('\n')
+            summary.append((qualname, co.co_firstlineno, count))
+    return summary
@@ -0,0 +1,203 @@
+"""
+Import hook for standalone ``.asm`` modules
+
+Once install() has been called, ``import foo`` will load ``foo.asm`` if
+there is no ``foo.py``. The file holds any number of functions, each
+starting with a ``.function`` directive naming it and followed by the
+usual directives::
+
+    .function fib
+    .params n
+    .locals a, b, idx
+    .names range
+    .consts
+      int0 = 0
+      int1 = 1
+    .code
+      ...
+
+As with ``.py`` files, the module code is cached in ``__pycache__``, so
+later imports just unmarshal it. A function with free variables can't be
+created at module level, so its code object is stored instead, as the
+asm decorator does.
+"""
+from importlib.machinery import (
+    FileFinder, SourceFileLoader, SourcelessFileLoader, ExtensionFileLoader,
+    SOURCE_SUFFIXES, BYTECODE_SUFFIXES, EXTENSION_SUFFIXES
+)
+import io
+import sys
+import types
+
+from cpython_assembly import asm
+
+ASM_SUFFIXES = ['.asm']
+
+_PATH_HOOK = None
+
+
+class AsmLoader(SourceFileLoader):
+    """
+    Loader for ``.asm`` files, caching bytecode just like the
+    loader for ``.py`` files
+    """
+    def source_to_code(self, data, path, *, _optimize=-1):
+        return compile_module(data.decode('utf-8'), path)
+
+    def path_stats(self, path):
+        """
+        Stats of the source file that the bytecode is checked against,
+        with the mtime mixed with the digest of the assembler, so that
+        bytecode written by another version of it is stale. The size is
+        taken from the source itself when writing, so it can't be used.
+        """
+        stats = super().path_stats(path)
+        tag = int.from_bytes(asm._assembler_digest()[:4], 'little')
+        return {'mtime': int(stats['mtime']) ^ tag, 'size': stats['size']}
+
+
+def install():
+    """
+    Make ``.asm`` files importable. Regular python modules still take
+    precedence over an ``.asm`` file of the same name.
+    """
+    global _PATH_HOOK
+    if _PATH_HOOK is not None:
+        return
+    _PATH_HOOK = FileFinder.path_hook(
+        (ExtensionFileLoader, EXTENSION_SUFFIXES),
+        (SourceFileLoader, SOURCE_SUFFIXES),
+        (SourcelessFileLoader, BYTECODE_SUFFIXES),
+        (AsmLoader, ASM_SUFFIXES)
+    )
+    sys.path_hooks.insert(0, _PATH_HOOK)
+    sys.path_importer_cache.clear()
+
+
+def uninstall():
+    """
+    Remove the import hook again
+    """
+    global _PATH_HOOK
+    if _PATH_HOOK is None:
+        return
+    sys.path_hooks.remove(_PATH_HOOK)
+    sys.path_importer_cache.clear()
+    _PATH_HOOK = None
+
+
+def compile_module(source, filename='<asm>'):
+    """
+    Assemble the functions in an ``.asm`` source and return the code
+    for a module defining them
+    """
+    functions = [
+        _assemble_function(lines, start, filename)
+        for start, lines in _split_functions(source, filename)
+    ]
+    return _module_code(functions, filename)
+
+
+def _split_functions(source, filename):
+    """
+    Yield the first line number and the lines of each function
+    """
+    start = None
+    lines = []
+    for lno, line in enumerate(io.StringIO(source), 1):
+        text = line.split(';', 1)[0].strip()
+        if text.startswith('.function'):
+            if start is not None:
+                yield start, lines
+            start = lno
+            lines = []
+        elif text and start is None:
+            raise SyntaxError(
+                'asm source outside of a .function',
+                (filename, lno, 1, line)
+            )
+        lines.append(line)
+    if start is not None:
+        yield start, lines
+
+
+def _assemble_function(lines, start, filename):
+    """
+    Assemble one function and return its name and code
+    """
+    # line i of the function is line start + i of the file
+    machine = asm.Assembler(lines, lnodoc=-1)
+    names = machine.src.get('function', ())
+    if len(names) != 1 or not names[0].isidentifier():
+        raise SyntaxError(
+            '.function needs a name', (filename, start, 1, lines[0])
+        )
+    name = names[0]
+
+    machine.flags = asm.CO_FLAGS['OPTIMIZED'] | asm.CO_FLAGS['NEWLOCALS']
+    if 'freevars' not in machine.src and 'cellvars' not in machine.src:
+        machine.flags |= asm.CO_FLAGS['NOFREE']
+    machine.fl = start
+    co = machine.assemble()
+
+    return name, types.CodeType(
+        co.co_argcount,
+        0,
+        co.co_nlocals,
+        co.co_stacksize,
+        co.co_flags,
+        co.co_code,
+        co.co_consts,
+        co.co_names,
+        co.co_varnames,
+        filename,
+        name,
+        start,
+        co.co_lnotab,
+        co.co_freevars,
+        co.co_cellvars
+    )
+
+
+def _module_code(functions, filename):
+    """
+    Assemble module code that binds each function to its name
+    """
+    count = len(functions)
+    source = ['.flags nofree', '.consts', '  none = None']
+    for idx in range(count):
+        source.append('  code{0} = args[{0}]'.format(idx))
+        source.append('  name{0} = args[{1}]'.format(idx, idx + count))
+    if functions:
+        source.append('.names ' + ', '.join(name for name, _ in functions))
+    source.append('.code')
+    for idx, (name, code) in enumerate(functions):
+        source.append('  LOAD_CONST    code{0}'.format(idx))
+        if not code.co_freevars:
+            source.append('  LOAD_CONST    name{0}'.format(idx))
+            source.append('  MAKE_FUNCTION 0')
+        source.append('  STORE_NAME    {0}'.format(name))
+    source.append('  LOAD_CONST    none')
+    source.append('  RETURN_VALUE')
+
+    args = tuple(code for _, code in functions)
+    args += tuple(name for name, _ in functions)
+    co = asm.Assembler(source, args=args).assemble()
+
+    return types.CodeType(
+        0,
+        0,
+        0,
+        co.co_stacksize,
+        co.co_flags,
+        co.co_code,
+        co.co_consts,
+        co.co_names,
+        (),
+        filename,
+        '<module>',
+        1,
+        b'',
+        (),
+        ()
+    )
@@ -0,0 +1,187 @@
+"""
+Instruction level profiling of assembled functions
+
+    from cpython_assembly.profile import Profile
+
+    with Profile(fib) as prof:
+        fib(1000)
+    print(prof.report(fib))
+
+counts how many times each instruction of the chosen functions runs and
+the time spent on it, and reports it as a dis() listing annotated with
+the counts, times and the asm source line of each instruction.
+
+From python 3.7 the functions are traced opcode by opcode
+(``frame.f_trace_opcodes``). Python 3.6 only has line events, which for
+asm source written one instruction per line come to the same thing, but
+instructions sharing a source line are counted together on the first.
+
+Times are wall clock from one instruction to the next, so an instruction
+calling a function includes the time spent in the call.
+"""
+from bisect import bisect_right
+from dis import findlinestarts
+from time import perf_counter
+import json
+import sys
+
+from cpython_assembly import asm
+
+_OPCODE_EVENTS = sys.version_info >= (3, 7)
+
+
+class Profile:
+    """
+    Collects per-instruction counts and times for the given functions
+    (or code objects) while enabled. Only the thread enabling it is
+    traced.
+    """
+    def __init__(self, *funcs):
+        self.codes = set(_code(func) for func in funcs)
+        # code -> offset -> [count, seconds]
+        self.stats = {code: {} for code in self.codes}
+        self._previous = None
+
+    def add(self, func):
+        code = _code(func)
+        self.codes.add(code)
+        self.stats.setdefault(code, {})
+
+    def enable(self):
+        self._previous = sys.gettrace()
+        sys.settrace(self._trace)
+
+    def disable(self):
+        sys.settrace(self._previous)
+        self._previous = None
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disable()
+
+    def _trace(self, frame, event, arg):
+        """
+        Global trace function, only tracing frames of profiled code
+        """
+        code = frame.f_code
+        if code not in self.codes:
+            return None
+        if _OPCODE_EVENTS:
+            frame.f_trace_opcodes = True
+            frame.f_trace_lines = False
+        return _FrameTracer(self.stats[code])
+
+    def counts(self, func):
+        """
+        Dict of bytecode offset to (count, seconds)
+        """
+        stats = self.stats.get(_code(func), {})
+        return {
+            offset: tuple(entry) for offset, entry in stats.items()
+        }
+
+    def line_stats(self, func):
+        """
+        Dict of asm source line number to (count, seconds), summing
+        the instructions on each line
+        """
+        code = _code(func)
+        linestarts = list(findlinestarts(code))
+        lines = {}
+        for offset, (count, seconds) in self.counts(code).items():
+            lno = _line_for(linestarts, offset)
+            total = lines.get(lno, (0, 0.0))
+            lines[lno] = (total[0] + count, total[1] + seconds)
+        return lines
+
+    def dump(self, func, file):
+        """
+        Write the run count of each source line of a function as JSON,
+        to be passed as layout_profile when assembling it again
+        """
+        counts = {
+            str(lno): count
+            for lno, (count, _) in self.line_stats(func).items()
+            if lno is not None
+        }
+        json.dump(counts, file, indent=2, sort_keys=True)
+
+    def report(self, func, file=None):
+        """
+        The dis() listing of a function with the count, time and
+        source line of each instruction as a comment. Written to file
+        if given, otherwise returned.
+
+        Events on an EXTENDED_ARG prefix are counted with the
+        instruction it prefixes.
+        """
+        code, doc = asm._code_and_doc(func)
+        listing = list(asm._dis_code(code, doc))
+        starts = [offset for offset, _ in listing if offset is not None]
+        counts = {}
+        for offset, (count, seconds) in self.counts(code).items():
+            start = starts[bisect_right(starts, offset) - 1]
+            total = counts.get(start, (0, 0.0))
+            counts[start] = (total[0] + count, total[1] + seconds)
+        total = sum(seconds for _, seconds in counts.values())
+        linestarts = list(findlinestarts(code))
+
+        result = ['    ; profile: {0:.6f}s'.format(total)]
+        result.extend(asm._dis_header(code, doc))
+        for offset, line in listing:
+            if offset is not None:
+                count, seconds = counts.get(offset, (0, 0.0))
+                line = '{0: <50} ; {1:>10} {2:12.6f}s  line {3}'.format(
+                    line, count, seconds, _line_for(linestarts, offset)
+                )
+            result.append(line)
+        text = '\n'.join(result)
+        if file is None:
+            return text
+        file.write(text)
+        file.write('\n')
+
+
+class _FrameTracer:
+    """
+    Local trace function for one frame, charging the time since the
+    previous event to the previous instruction
+    """
+    __slots__ = ('stats', 'offset', 'last')
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.offset = None
+        self.last = 0.0
+
+    def __call__(self, frame, event, arg):
+        now = perf_counter()
+        if self.offset is not None:
+            self.stats[self.offset][1] += now - self.last
+        if event == 'opcode' or event == 'line':
+            offset = frame.f_lasti
+            entry = self.stats.get(offset)
+            if entry is None:
+                entry = self.stats[offset] = [0, 0.0]
+            entry[0] += 1
+            self.offset = offset
+        elif event == 'return':
+            self.offset = None
+        self.last = perf_counter()
+        return self
+
+
+def _code(func):
+    return getattr(func, '__code__', func)
+
+
+def _line_for(linestarts, offset):
+    """
+    Source line of the instruction at offset, from the lnotab line
+    starts
+    """
+    idx = bisect_right(linestarts, (offset, sys.maxsize)) - 1
+    return linestarts[idx][1] if idx >= 0 else None
@@ -0,0 +1,44 @@
+from cpython_assembly.asm import asm
+
+
+@asm(lazy=True)
+def double(x):
+    """
+    Double it
+    :::asm
+    .consts
+      two = 2
+    .code
+      LOAD_FAST                x
+      LOAD_CONST               two
+      BINARY_MULTIPLY
+      RETURN_VALUE
+    """
+
+
+@asm(3, lazy=True)
+def scale(x):
+    """
+    Scale by the decorator argument
+    :::asm
+    .consts
+      factor = args[0]
+    .code
+      LOAD_FAST                x
+      LOAD_CONST               factor
+      BINARY_MULTIPLY
+      RETURN_VALUE
+    """
+
+
+@asm(lazy=True, optimize=1)
+def negate(x):
+    """
+    Negate it
+    :::asm
+    .code
+      NOP
+      LOAD_FAST                x
+      UNARY_NEGATIVE
+      RETURN_VALUE
+    """
@@ -0,0 +1,9 @@
+"""
+Tests assert on what the assembler does, so they don't read or write
+the disk cache in tests/__pycache__. Tests of the cache turn it back on
+for modules in a temporary directory.
+"""
+import cpython_assembly.asm as asm
+
+
+asm.DISK_CACHE = False
@@ -3,7 +3,17 @@ Still figuring out what I'm doing here
 """
 import cpython_assembly.asm as asm
 import dis
+from dis import findlinestarts
+import inspect
+import io
+import os
+import sys
+import threading
+import time
 import traceback
+import types
+
+import pytest
 
 
 SAMPLE_CODE = """\
@@ -488,3 +498,1618 @@ def test_closure_metafib():
 
     assert fib(6) == 8
     assert fib(7) == 13
+
+
+def test_assemble_code_extended_jump():
+    machine = asm.Assembler()
+    machine.src['code'] = (
+        ['JUMP_ABSOLUTE end'] + ['NOP'] * 200 + ['end: RETURN_VALUE']
+    )
+    # fake the line numbers
+    machine.src['code'] = enumerate(machine.src['code'], 1)
+
+    machine.assemble_code()
+
+    # the jump needs an EXTENDED_ARG, which pushes its target to 404
+    assert machine.code == b'\x90\x01q\x94' + b'\t\x00' * 200 + b'S\x00'
+    assert machine.bytecode_lno == [0, 1] + list(range(2, 203))
+
+
+def test_assemble_code_extended_relative_jump():
+    machine = asm.Assembler()
+    machine.src['code'] = (
+        ['JUMP_FORWARD end'] + ['NOP'] * 200 + ['end: RETURN_VALUE']
+    )
+    # fake the line numbers
+    machine.src['code'] = enumerate(machine.src['code'], 1)
+
+    machine.assemble_code()
+
+    assert machine.code == b'\x90\x01n\x90' + b'\t\x00' * 200 + b'S\x00'
+
+
+def _make_triple(factor):
+    def triple(x):
+        """
+        Multiply by a constant
+        :::asm
+        .stacksize 2
+        .consts
+          factor = args[0]
+        .code
+          LOAD_FAST                x
+          LOAD_CONST               factor
+          BINARY_MULTIPLY
+          RETURN_VALUE
+        """
+    return triple
+
+
+TRIPLE_MODULE = '''\
+def make_triple(factor):
+    def triple(x):
+        """
+        Multiply by a constant
+        :::asm
+        .stacksize 2
+        .consts
+          factor = args[0]
+        .code
+          LOAD_FAST                x
+          LOAD_CONST               factor
+          BINARY_MULTIPLY
+          RETURN_VALUE
+        """
+    return triple
+'''
+
+
+def _cached_triple(tmp_path, monkeypatch):
+    """
+    _make_triple defined in a module in tmp_path, so that its disk cache
+    entries go there
+    """
+    monkeypatch.setattr(asm, 'DISK_CACHE', True)
+    monkeypatch.setattr(asm.sys, 'dont_write_bytecode', False)
+    path = tmp_path / 'cachemod.py'
+    path.write_text(TRIPLE_MODULE)
+    namespace = {'__name__': 'cachemod'}
+    exec(compile(TRIPLE_MODULE, str(path), 'exec'), namespace)
+    return namespace['make_triple']
+
+
+def test_disk_cache(tmp_path, monkeypatch):
+    make_triple = _cached_triple(tmp_path, monkeypatch)
+    f = make_triple(3)
+    doc, source = f.__doc__.split(':::asm')
+    path, key = asm._cache_entry(f, source, doc, (3,), {})
+    assert os.path.dirname(path) == str(tmp_path / '__pycache__')
+
+    assert asm.asm(3)(f)(2) == 6
+    assert os.path.exists(path)
+
+    def broken(self):
+        raise AssertionError('should have been cached')
+
+    assemble = asm.Assembler.assemble
+    monkeypatch.setattr(asm.Assembler, 'assemble', broken)
+    assert asm.asm(3)(make_triple(3))(2) == 6
+
+    # different args are a different key, so the entry is stale
+    with pytest.raises(AssertionError):
+        asm.asm(4)(make_triple(4))
+
+    monkeypatch.setattr(asm.Assembler, 'assemble', assemble)
+    assert asm.asm(4)(make_triple(4))(2) == 8
+    assert asm.asm(4, optimize=1)(make_triple(4))(2) == 8
+    # and replaced, there is only ever one file for the function
+    with open(path, 'rb') as fp:
+        assert not fp.read().startswith(asm.MAGIC_NUMBER + key)
+    assert os.listdir(os.path.dirname(path)) == [os.path.basename(path)]
+
+    monkeypatch.setattr(asm.Assembler, 'assemble', broken)
+    assert asm.asm(4, optimize=1)(make_triple(4))(2) == 8
+
+
+def test_disk_cache_unmarshallable_args(tmp_path, monkeypatch):
+    f = _cached_triple(tmp_path, monkeypatch)(object())
+    doc, source = f.__doc__.split(':::asm')
+    assert asm._cache_entry(f, source, doc, (1,), {}) is not None
+
+    assert asm._cache_entry(f, source, doc, (object(),), {}) is None
+
+
+def test_code_cache_shared():
+    asm.CODE_CACHE.clear()
+    first = asm.Assembler(SAMPLE_CODE).assemble()
+    second = asm.Assembler(SAMPLE_CODE.replace('4', '4 ; same')).assemble()
+    other = asm.Assembler(SAMPLE_CODE.replace('4', '4.0')).assemble()
+
+    assert first is second
+    assert other is not first
+    assert other.co_consts == (None, 4.0)
+    assert asm.CODE_CACHE.info() == asm.CacheInfo(1, 2, 128, 2)
+
+
+def test_code_cache_lnodoc():
+    asm.CODE_CACHE.clear()
+    first = asm.Assembler(SAMPLE_CODE).assemble()
+    shifted = asm.Assembler(SAMPLE_CODE, lnodoc=-1).assemble()
+
+    assert shifted is not first
+    assert [line for _, line in findlinestarts(shifted)] == [
+        line - 1 for _, line in findlinestarts(first)
+    ]
+
+
+def test_code_cache_resize():
+    cache = asm.CodeCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+
+    # b was least recently used
+    assert cache.get('b') is None
+    cache.resize(1)
+    assert cache.get('a') is None
+    assert cache.get('c') == 3
+    assert cache.info() == asm.CacheInfo(2, 2, 1, 1)
+
+    cache.clear()
+    assert cache.info() == asm.CacheInfo(0, 0, 1, 0)
+
+
+def test_fix_arguments_symbols():
+    machine = asm.Assembler()
+    machine.src['cellvars'] = ['c, shared']
+    machine.src['freevars'] = ['shared, f']
+    machine.src['names'] = ['x, y, x']
+    machine.src['locals'] = ['a, b']
+    machine.src['code'] = enumerate([
+        'LOAD_CLOSURE  f',
+        'LOAD_DEREF    shared',
+        'LOAD_GLOBAL   x',
+        'LOAD_GLOBAL   y',
+        'STORE_FAST    b',
+    ])
+    machine.assemble_locals()
+    machine.assemble_names()
+    machine.assemble_freevars()
+    machine.assemble_cellvars()
+    machine.assemble_code()
+
+    assert machine.bytecode[1::2] == [3, 1, 0, 1, 1]
+
+
+def test_opcode_kinds():
+    assert asm._OPCODE_KIND[dis.opmap['JUMP_ABSOLUTE']] == asm._ARG_JABS
+    assert asm._OPCODE_KIND[dis.opmap['FOR_ITER']] == asm._ARG_JREL
+    assert asm._OPCODE_KIND[dis.opmap['STORE_FAST']] == asm._ARG_LOCAL
+    assert asm._OPCODE_KIND[dis.opmap['LOAD_ATTR']] == asm._ARG_NAME
+    assert asm._OPCODE_KIND[dis.opmap['LOAD_CONST']] == asm._ARG_CONST
+    assert asm._OPCODE_KIND[dis.opmap['LOAD_CLOSURE']] == asm._ARG_FREE
+    assert asm._OPCODE_KIND[dis.opmap['BINARY_ADD']] == asm._ARG_NONE
+
+
+def test_tokenize():
+    tokens = list(asm.tokenize(SAMPLE_CODE.splitlines()))
+
+    assert tokens[:4] == [
+        asm.Token('directive', 1, 'stacksize', None),
+        asm.Token('line', 1, '2', None),
+        asm.Token('directive', 3, 'consts', None),
+        asm.Token('line', 4, '4', None),
+    ]
+    assert tokens[5] == asm.Token('op', 8, 'LOAD_FAST', '0')
+    assert tokens[7] == asm.Token('op', 10, 'BINARY_ADD', None)
+    assert len(tokens) == 9
+
+
+def test_tokenize_labels():
+    tokens = list(asm.tokenize(['.code', 'foo: load_fast 0', '  bar:']))
+
+    assert tokens == [
+        asm.Token('directive', 0, 'code', None),
+        asm.Token('label', 1, 'foo', None),
+        asm.Token('op', 1, 'LOAD_FAST', '0'),
+        asm.Token('label', 2, 'bar', None),
+    ]
+
+
+def test_assembler_file_source():
+    from_str = asm.Assembler(SAMPLE_CODE)
+    from_file = asm.Assembler(io.StringIO(SAMPLE_CODE))
+
+    assert from_file.src == from_str.src
+    assert from_file.bytecode == from_str.bytecode == [124, 0, 100, 1, 23, 0, 83, 0]
+    assert from_file.bytecode_lno == [8, 9, 10, 11]
+
+
+def test_assemble_stacksize_auto():
+    machine = asm.Assembler()
+    machine.src['stacksize'] = ['auto']
+
+    machine.assemble_stacksize()
+
+    assert machine.stacksize is None
+
+
+def test_fibonacci_auto_stacksize():
+
+    @asm.asm
+    def fib(n):
+        """
+        Return the nth fibonacci number
+        :::asm
+
+        .flags optimized, newlocals, nofree
+        .locals a, b, idx
+        .names range
+        .consts
+          int0 = 0
+          int1 = 1
+
+        .code
+          LOAD_CONST               int0
+          STORE_FAST               a
+
+          LOAD_CONST               int1
+          STORE_FAST               b
+
+          SETUP_LOOP               after_loop
+          LOAD_GLOBAL              range
+          LOAD_FAST                n
+          CALL_FUNCTION            1
+          GET_ITER
+        start_loop:
+          FOR_ITER                 end_loop
+          STORE_FAST               idx
+          LOAD_FAST                b
+          LOAD_FAST                a
+          LOAD_FAST                b
+          BINARY_ADD
+          ROT_TWO
+          STORE_FAST               a
+          STORE_FAST               b
+          JUMP_ABSOLUTE            start_loop
+        end_loop:
+          POP_BLOCK
+        after_loop:
+          LOAD_FAST                a
+          RETURN_VALUE
+        """
+
+    assert fib.__code__.co_stacksize == 4
+    assert fib(7) == 13
+
+
+def test_asm_without_source():
+    def plain(x):
+        """
+        Not assembly
+        ::asm
+        .code
+          LOAD_FAST x
+          RETURN_VALUE
+        """
+        return -x
+
+    with pytest.raises(ValueError) as e:
+        asm.asm(plain)
+    assert 'plain has no :::asm source' in str(e.value)
+    plain.__doc__ = None
+    with pytest.raises(ValueError):
+        asm.asm(optimize=1)(plain)
+
+
+def test_max_stack_depth():
+
+    def simple(x, y):
+        return (x + y) * (x - y)
+
+    def loops(n):
+        total = 0
+        for i in range(n):
+            for j in range(i):
+                total += i * j
+        return total
+
+    def handler(x):
+        try:
+            return x[0]
+        except (IndexError, KeyError) as e:
+            return e
+        finally:
+            x.clear()
+
+    assert asm.max_stack_depth(simple.__code__.co_code) == 3
+    assert asm.max_stack_depth(loops.__code__.co_code) == 5
+    # the compiler overestimates exception handlers
+    assert asm.max_stack_depth(handler.__code__.co_code) <= (
+        handler.__code__.co_stacksize
+    )
+
+
+def test_auto_stacksize_loop_except():
+
+    @asm.asm
+    def count(xs):
+        """
+        Count the items that 1 can be floor divided by, minus the others
+        :::asm
+
+        .flags optimized, newlocals, nofree
+        .locals n, x
+        .names ZeroDivisionError
+        .consts
+          int0 = 0
+          int1 = 1
+
+        .code
+          LOAD_CONST               int0
+          STORE_FAST               n
+          SETUP_LOOP               after_loop
+          LOAD_FAST                xs
+          GET_ITER
+        start_loop:
+          FOR_ITER                 end_loop
+          STORE_FAST               x
+          SETUP_EXCEPT             handler
+          LOAD_FAST                n
+          LOAD_CONST               int1
+          LOAD_FAST                x
+          BINARY_FLOOR_DIVIDE
+          INPLACE_ADD
+          STORE_FAST               n
+          POP_BLOCK
+          JUMP_ABSOLUTE            start_loop
+        handler:
+          DUP_TOP
+          LOAD_GLOBAL              ZeroDivisionError
+          COMPARE_OP               10
+          POP_JUMP_IF_FALSE        reraise
+          POP_TOP
+          POP_TOP
+          POP_TOP
+          LOAD_FAST                n
+          LOAD_CONST               int1
+          INPLACE_SUBTRACT
+          STORE_FAST               n
+          POP_EXCEPT
+          JUMP_ABSOLUTE            start_loop
+        reraise:
+          END_FINALLY
+          JUMP_ABSOLUTE            start_loop
+        end_loop:
+          POP_BLOCK
+        after_loop:
+          LOAD_FAST                n
+          RETURN_VALUE
+        """
+
+    def compiled(xs):
+        n = 0
+        for x in xs:
+            try:
+                n += 1 // x
+            except ZeroDivisionError:
+                n -= 1
+        return n
+
+    assert count([1, 0, 2, 0, 1]) == 0
+    assert count.__code__.co_stacksize == asm.max_stack_depth(
+        compiled.__code__.co_code
+    )
+    assert count.__code__.co_stacksize <= compiled.__code__.co_stacksize
+
+
+def test_auto_stacksize_loop_with():
+
+    @asm.asm
+    def append_all(xs, lock):
+        """
+        Append 1 to each list in xs while holding lock
+        :::asm
+
+        .flags optimized, newlocals, nofree
+        .locals x
+        .names append
+        .consts
+          none = None
+          int1 = 1
+
+        .code
+          SETUP_LOOP               after_loop
+          LOAD_FAST                xs
+          GET_ITER
+        start_loop:
+          FOR_ITER                 end_loop
+          STORE_FAST               x
+          LOAD_FAST                lock
+          SETUP_WITH               cleanup
+          POP_TOP
+          LOAD_FAST                x
+          LOAD_ATTR                append
+          LOAD_CONST               int1
+          CALL_FUNCTION            1
+          POP_TOP
+          POP_BLOCK
+          LOAD_CONST               none
+        cleanup:
+          WITH_CLEANUP_START
+          WITH_CLEANUP_FINISH
+          END_FINALLY
+          JUMP_ABSOLUTE            start_loop
+        end_loop:
+          POP_BLOCK
+        after_loop:
+          LOAD_FAST                xs
+          RETURN_VALUE
+        """
+
+    def compiled(xs, lock):
+        for x in xs:
+            with lock:
+                x.append(1)
+        return xs
+
+    assert append_all([[], [2]], threading.Lock()) == [[1], [2, 1]]
+    assert append_all.__code__.co_stacksize <= (
+        compiled.__code__.co_stacksize
+    )
+    assert asm.max_stack_depth(compiled.__code__.co_code) <= (
+        compiled.__code__.co_stacksize
+    )
+
+
+def test_optimize_code():
+    machine = asm.Assembler(optimize=1)
+    machine.src['code'] = enumerate([
+        '   JUMP_ABSOLUTE      a',
+        '   NOP',
+        'a: JUMP_FORWARD       b',
+        '   LOAD_CONST         0',
+        'b: NOP',
+        '   LOAD_FAST          0',
+        '   POP_JUMP_IF_FALSE  c',
+        '   LOAD_FAST          0',
+        '   RETURN_VALUE',
+        'c: LOAD_CONST         0',
+        '   RETURN_VALUE',
+    ])
+
+    machine.assemble_code()
+
+    assert machine.code == b'|\x00r\x08|\x00S\x00d\x00S\x00'
+    assert machine.bytecode_lno == [5, 6, 7, 8, 9, 10]
+    assert machine.targets == {'a': 0, 'b': 0, 'c': 8}
+
+
+def test_optimize_jump_to_return():
+    machine = asm.Assembler(optimize=1)
+    machine.src['code'] = enumerate([
+        '     LOAD_FAST          0',
+        '     POP_JUMP_IF_TRUE   other',
+        '     LOAD_CONST         0',
+        '     JUMP_FORWARD       end',
+        'other: LOAD_CONST       1',
+        'end: RETURN_VALUE',
+    ])
+
+    machine.assemble_code()
+
+    assert machine.code == b'|\x00s\x08d\x00S\x00d\x01S\x00'
+
+
+def test_optimize_directive():
+    machine = asm.Assembler('.optimize\n.code\nNOP\nLOAD_FAST 0\nRETURN_VALUE')
+    machine.assemble_optimize()
+    machine.assemble_code()
+
+    assert machine.optimize == 1
+    assert machine.code == b'|\x00S\x00'
+    assert machine.bytecode_lno == [3, 4]
+
+
+def test_fibonacci_optimized():
+
+    def fib(n):
+        """
+        Return the nth fibonacci number
+        :::asm
+
+        .stacksize 4
+        .flags optimized, newlocals, nofree
+        .locals a, b, idx
+        .names range
+        .consts
+          int0 = 0
+          int1 = 1
+
+        .code
+          LOAD_CONST               int0
+          STORE_FAST               a
+
+          LOAD_CONST               int1
+          STORE_FAST               b
+
+          SETUP_LOOP               after_loop
+        """
+
+    nops = ["NOP"]*500
+    fib.__doc__ += '\n'.join(nops)
+    fib.__doc__ += """
+          LOAD_GLOBAL              range
+          LOAD_FAST                n
+          CALL_FUNCTION            1
+          GET_ITER
+        start_loop:
+          FOR_ITER                 end_loop
+          STORE_FAST               idx
+          LOAD_FAST                b
+          LOAD_FAST                a
+          LOAD_FAST                b
+          BINARY_ADD
+          ROT_TWO
+          STORE_FAST               a
+          STORE_FAST               b
+          JUMP_ABSOLUTE            start_loop
+          LOAD_FAST                idx
+          RETURN_VALUE
+        end_loop:
+          POP_BLOCK
+        after_loop:
+          LOAD_FAST                a
+          RETURN_VALUE
+        """
+    fib = asm.asm(optimize=1)(fib)
+
+    assert fib(6) == 8
+    assert fib(7) == 13
+    assert len(fib.__code__.co_code) == 44
+
+
+def test_optimize_traceback():
+
+    @asm.asm(optimize=1)
+    def bad(x):
+        """
+        Raise from optimized code
+        :::asm
+        .names ValueError
+        .code
+          JUMP_ABSOLUTE            skip
+          NOP
+          LOAD_FAST                x
+          RETURN_VALUE
+        skip:
+          NOP
+          LOAD_GLOBAL              ValueError
+          RAISE_VARARGS            1
+        """
+
+    with pytest.raises(ValueError) as info:
+        bad(0)
+
+    lno = traceback.extract_tb(info.value.__traceback__)[-1][1]
+    with open(__file__) as fp:
+        line = fp.read().splitlines()[lno - 1]
+    assert line.strip() == 'RAISE_VARARGS            1'
+    assert bad.__code__.co_code == b't\x00\x82\x01'
+
+
+def _fold_machine(code, consts):
+    machine = asm.Assembler(optimize=1)
+    machine.consts = consts
+    machine.src['code'] = enumerate(code)
+    machine.assemble_code()
+    return machine
+
+
+def test_fold_constants():
+    machine = _fold_machine([
+        'LOAD_CONST 1',
+        'LOAD_CONST 2',
+        'BINARY_MULTIPLY',
+        'LOAD_CONST 1',
+        'BINARY_ADD',
+        'UNARY_NEGATIVE',
+        'LOAD_CONST 3',
+        'BUILD_TUPLE 2',
+        'RETURN_VALUE',
+    ], (None, 2, 3, 'x'))
+
+    assert machine.consts == (None, 2, 3, 'x', 6, 8, -8, (-8, 'x'))
+    assert machine.code == b'd\x07S\x00'
+    assert machine.bytecode_lno == [0, 8]
+
+
+def test_fold_constants_reuses_consts():
+    machine = _fold_machine([
+        'LOAD_CONST 1',
+        'LOAD_CONST 1',
+        'BINARY_ADD',
+        'RETURN_VALUE',
+    ], (None, 2, 4.0, 4))
+
+    assert machine.consts == (None, 2, 4.0, 4)
+    assert machine.code == b'd\x03S\x00'
+
+
+def test_fold_constants_limits():
+    machine = _fold_machine([
+        'LOAD_CONST 1',
+        'LOAD_CONST 2',
+        'BINARY_MULTIPLY',
+        'LOAD_CONST 2',
+        'LOAD_CONST 3',
+        'BINARY_TRUE_DIVIDE',
+        'LOAD_CONST 2',
+        'LOAD_CONST 4',
+        'BINARY_POWER',
+        'BUILD_TUPLE 3',
+        'RETURN_VALUE',
+    ], (None, 'ab', 21, 0, 1000))
+
+    # too long, raises and too large
+    assert machine.consts == (None, 'ab', 21, 0, 1000)
+    assert len(machine.code) == 22
+
+    machine = _fold_machine([
+        'LOAD_CONST 1',
+        'LOAD_CONST 2',
+        'BINARY_MODULO',
+        'LOAD_CONST 3',
+        'LOAD_CONST 2',
+        'BINARY_MODULO',
+        'LOAD_CONST 4',
+        'LOAD_CONST 2',
+        'BINARY_MODULO',
+        'BUILD_TUPLE 3',
+        'RETURN_VALUE',
+    ], (None, '%999999999d', 1, b'%d', 7))
+
+    # string formatting isn't folded, other modulos are
+    assert machine.consts == (None, '%999999999d', 1, b'%d', 7, 0)
+    assert len(machine.code) == 18
+
+
+def test_fold_constants_jump_target():
+    machine = _fold_machine([
+        '   LOAD_FAST          0',
+        '   POP_JUMP_IF_TRUE   in',
+        '   LOAD_CONST         1',
+        'in: LOAD_CONST        1',
+        '   BINARY_ADD',
+        '   RETURN_VALUE',
+    ], (None, 1))
+
+    assert machine.consts == (None, 1)
+    assert machine.code == b'|\x00s\x06d\x01d\x01\x17\x00S\x00'
+
+
+def test_fold_constant_branches():
+    machine = _fold_machine([
+        '   LOAD_CONST         1',
+        '   LOAD_CONST         2',
+        '   COMPARE_OP         0',
+        '   POP_JUMP_IF_FALSE  other',
+        '   LOAD_CONST         1',
+        '   RETURN_VALUE',
+        'other:',
+        '   LOAD_CONST         2',
+        '   RETURN_VALUE',
+    ], (None, 1, 2))
+
+    assert machine.code == b'd\x01S\x00'
+
+    machine = _fold_machine([
+        '   LOAD_CONST         0',
+        '   POP_JUMP_IF_FALSE  other',
+        '   LOAD_CONST         1',
+        '   RETURN_VALUE',
+        'other:',
+        '   LOAD_CONST         2',
+        '   RETURN_VALUE',
+    ], (None, 1, 2))
+
+    assert machine.code == b'd\x02S\x00'
+
+
+def test_assemble_consts_literal_cache():
+    asm._parse_const.cache_clear()
+    for _ in range(2):
+        machine = asm.Assembler()
+        machine.args = (5,)
+        machine.src['consts'] = [
+            'table = (1, 2.5, "a=b", None)',
+            'scaled = args[0] * 2',
+            'items = [1, 2]',
+            '-1'
+        ]
+        machine.assemble_consts()
+
+    assert machine.consts == (None, (1, 2.5, 'a=b', None), 10, [1, 2], -1)
+    assert machine.consts_alias == {
+        '__doc__': 0, 'table': 1, 'scaled': 2, 'items': 3
+    }
+    assert asm._parse_const.cache_info().hits == 4
+    assert asm._parse_const('-1') == (True, -1)
+    assert asm._parse_const('[1, 2]')[0] is False
+
+
+def test_assemble_consts_scope():
+    machine = asm.Assembler()
+    machine.src['consts'] = ['opmap']
+
+    with pytest.raises(NameError):
+        machine.assemble_consts()
+
+
+def _make_lazy_add():
+    def add(x, y=10, *, z=100):
+        """
+        Add things up
+        :::asm
+        .code
+          LOAD_FAST                x
+          LOAD_FAST                y
+          BINARY_ADD
+          LOAD_FAST                z
+          BINARY_ADD
+          RETURN_VALUE
+        """
+    return asm.asm(lazy=True)(add)
+
+
+def test_lazy(monkeypatch):
+    calls = []
+    assemble = asm._assemble_function
+
+    def counting(*args):
+        calls.append(args)
+        return assemble(*args)
+
+    monkeypatch.setattr(asm, '_assemble_function', counting)
+    add = _make_lazy_add()
+    stub = add.__code__
+
+    assert calls == []
+    assert add.__doc__ == '\n        Add things up\n        '
+    assert add.__name__ == 'add'
+    assert add.__qualname__ == '_make_lazy_add.<locals>.add'
+    assert add.__module__ == __name__
+    assert add(1) == 111
+    assert add(1, 2, z=3) == 6
+    assert len(calls) == 1
+    assert add.__code__ is not stub
+    assert add.__defaults__ == (10,)
+    assert add.__kwdefaults__ == {'z': 100}
+    assert str(inspect.signature(add)) == '(x, y=10, *, z=100)'
+
+
+def test_lazy_threads(monkeypatch):
+    calls = []
+    assemble = asm._assemble_function
+
+    def slow(*args):
+        calls.append(args)
+        time.sleep(0.05)
+        return assemble(*args)
+
+    monkeypatch.setattr(asm, '_assemble_function', slow)
+    add = _make_lazy_add()
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(add(1, 2)))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [103] * 8
+    assert len(calls) == 1
+
+
+def test_lazy_threads_defaults(monkeypatch):
+    assemble = asm._assemble_function
+    add = _make_lazy_add()
+    lazy = add.__kwdefaults__['_asm_lazy']
+    installing = threading.Event()
+
+    class SlowDefaults:
+        """
+        The lazy function's original, taking its time to hand over its
+        defaults to widen the window while they are installed
+        """
+        def __init__(self, f):
+            self.f = f
+
+        def __getattr__(self, name):
+            return getattr(self.f, name)
+
+        @property
+        def __defaults__(self):
+            installing.set()
+            time.sleep(0.05)
+            return self.f.__defaults__
+
+    def slow(*args):
+        lazy.f = SlowDefaults(lazy.f)
+        return assemble(*args)
+
+    monkeypatch.setattr(asm, '_assemble_function', slow)
+    results = []
+    errors = []
+    stop = threading.Event()
+
+    def call():
+        installing.wait()
+        while not stop.is_set():
+            try:
+                results.append(add(1))
+            except Exception as exc:
+                errors.append(exc)
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    assert add(1) == 111
+    time.sleep(0.01)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert set(results) <= {111}
+
+
+def test_assemble_module():
+    from tests.assets import batch
+
+    stub = batch.double.__code__
+    assert asm.assemble_module(batch, max_workers=2) == 3
+    assert asm.assemble_module('tests.assets.batch') == 0
+
+    assert batch.double.__code__ is not stub
+    assert batch.double(4) == 8
+    assert batch.scale(4) == 12
+    assert batch.negate(4) == -4
+    assert batch.negate.__code__.co_code == b'|\x00\x0b\x00S\x00'
+
+
+def test_assembler_stats():
+    source = (
+        '.consts\n  one = 1\n.code\nJUMP_ABSOLUTE end\n'
+        + 'NOP\n' * 200 + 'end:\nLOAD_CONST one\nRETURN_VALUE\n'
+    )
+    asm.CODE_CACHE.clear()
+    assert asm.Assembler(source).stats is None
+
+    machine = asm.Assembler(source, stats=True)
+    co = machine.assemble()
+    stats = machine.stats
+
+    assert list(stats.phases) == [
+        'read', 'consts', 'stacksize', 'flags', 'params', 'locals', 'names',
+        'freevars', 'cellvars', 'optimize', 'code', 'lnotab',
+        'max_stack_depth'
+    ]
+    assert all(phase.seconds >= 0 for phase in stats.phases.values())
+    assert all(phase.peak_memory >= 0 for phase in stats.phases.values())
+    assert stats.seconds > 0
+    assert stats.cached is None
+    assert stats.instructions == 203
+    assert stats.extended_args == 1
+    assert stats.lnotab_size == len(co.co_lnotab)
+
+    machine = asm.Assembler(source, stats=True)
+    assert machine.assemble() is co
+    assert machine.stats.cached == 'memory'
+
+
+def test_stats_hook(monkeypatch):
+    received = []
+    asm.CODE_CACHE.clear()
+    monkeypatch.setattr(asm, 'DISK_CACHE', False)
+    monkeypatch.setattr(asm, 'STATS_HOOK', None)
+    assert asm.set_stats_hook(received.append) is None
+
+    assert asm.asm(5)(_make_triple(5))(2) == 10
+    assert asm.set_stats_hook(None) == received.append
+
+    assert len(received) == 1
+    stats = received[0]
+    assert stats.name == 'tests.test_asm._make_triple.<locals>.triple'
+    assert stats.instructions == 4
+    assert 'code' in stats.phases
+    assert repr(stats).startswith('<AssemblyStats tests.test_asm.')
+
+
+def _reassemble(listing, co):
+    doc, source = listing.split(':::asm')
+    return asm.Assembler(source, doc=doc, code=co).assemble()
+
+
+def test_dis_roundtrip():
+    from tests.assets.metafib import metafib
+
+    fib = metafib(0, 1)
+    co = fib.__code__
+    listing = asm.dis(fib)
+
+    assert '      LOAD_DEREF                a' in listing
+    assert '      FOR_ITER                  t38' in listing
+    assert '    .locals x, y, idx' in listing
+
+    def shell(n):
+        pass
+
+    new = _reassemble(listing, shell.__code__)
+    assert new.co_code == co.co_code
+    assert new.co_consts[0].strip() == co.co_consts[0].strip()
+    assert new.co_consts[1:] == co.co_consts[1:]
+    assert new.co_varnames == co.co_varnames
+    assert new.co_names == co.co_names
+    assert new.co_freevars == co.co_freevars
+    assert new.co_flags == co.co_flags
+    renew = types.FunctionType(
+        new, fib.__globals__, 'fib', None, fib.__closure__
+    )
+    assert [renew(n) for n in range(8)] == [fib(n) for n in range(8)]
+
+
+def test_dis_roundtrip_without_docstring():
+    def append(x):
+        x.append(1)
+
+    def locked(lock, x):
+        with lock:
+            x.append(1)
+        try:
+            return len(x)
+        finally:
+            x.pop()
+
+    assert 'LOAD_CONST                __doc__' not in asm.dis(append)
+    for func, args in (
+        (append, ([],)),
+        (locked, (threading.Lock(), [2])),
+    ):
+        co = func.__code__
+        new = _reassemble(asm.dis(func), co)
+        # the text before :::asm is always the first constant
+        assert new.co_consts[1:] == co.co_consts
+        assert new.co_names == co.co_names
+        renew = types.FunctionType(new, globals())
+        assert renew(*args) == func(*args)
+
+
+def test_dis_consts():
+    def f(x):
+        """Doc; with a semicolon"""
+        return (x in {1}, 'a;b', 2.5, -0.0, None)
+
+    listing = asm.dis(f)
+    assert "c2 = 'a\\x3bb'" in listing
+    assert 'c6 = args[0]  ; frozenset({1})' in listing
+
+    doc, source = listing.split(':::asm')
+    new = asm.Assembler(
+        source, doc=doc, code=f.__code__, args=(frozenset({1}),)
+    ).assemble()
+    assert new.co_code == f.__code__.co_code
+    assert asm._const_key(new.co_consts[1:]) == (
+        asm._const_key(f.__code__.co_consts[1:])
+    )
+
+
+def test_dis_extended_arg():
+    source = '.flags optimized\n.code\nJUMP_FORWARD end\n' + 'NOP\n' * 300 + (
+        'end:\nLOAD_CONST 0\nRETURN_VALUE\n'
+    )
+    co = asm.Assembler(source, doc='Doc').assemble()
+    assert co.co_code.startswith(b'\x90\x02')
+
+    out = io.StringIO()
+    assert asm.dis(co, file=out) is None
+    listing = out.getvalue()
+    assert 'EXTENDED_ARG' not in listing
+    assert '      JUMP_FORWARD              t604\n' in listing
+    assert '    t604:\n      LOAD_CONST                __doc__\n' in listing
+    assert _reassemble(listing, None).co_code == co.co_code
+
+
+def test_macro():
+    source = """\
+    .macro addto var, value
+      LOAD_FAST    var
+      LOAD_CONST   value
+      BINARY_ADD
+      STORE_FAST   var
+    .endm
+    .locals x
+    .consts
+      one = 1
+      two = 2
+    .code
+      LOAD_CONST   one
+      STORE_FAST   x
+      addto        x, two
+      ADDTO        x, one
+      LOAD_FAST    x
+      RETURN_VALUE
+    """
+    machine = asm.Assembler(source)
+    co = machine.assemble()
+
+    assert co.co_code == (
+        b'd\x01}\x00'
+        b'|\x00d\x02\x17\x00}\x00'
+        b'|\x00d\x01\x17\x00}\x00'
+        b'|\x00S\x00'
+    )
+    # expanded instructions take the line of the macro call
+    assert machine.bytecode_lno[2:10] == [13] * 4 + [14] * 4
+    assert list(machine.macros['ADDTO'].expanded) == ['x, two', 'x, one']
+
+
+def test_macro_errors():
+    with pytest.raises(ValueError) as e:
+        asm.Assembler('.macro m a\n.code\nNOP\n.endm')
+    assert '.code inside a .macro block' in str(e.value)
+    with pytest.raises(ValueError):
+        asm.Assembler('.macro m a\nNOP')
+    with pytest.raises(ValueError):
+        asm.Assembler('.code\n.endr')
+    with pytest.raises(ValueError) as e:
+        asm.Assembler('.macro m a\nLOAD_FAST a\n.endm\n.code\nm\n')
+    assert 'macro m takes 1 arguments, 0 given' in str(e.value)
+    with pytest.raises(ValueError) as e:
+        asm.Assembler('.macro m\nNOP\nm\n.endm\n.code\nNOP\nm\n')
+    assert 'line 2: recursive macro m' in str(e.value)
+    with pytest.raises(ValueError) as e:
+        asm.Assembler(
+            '.macro a\nb\n.endm\n.macro b\na\n.endm\n.code\na\n'
+        )
+    assert 'line 4: recursive macro a' in str(e.value)
+    for count in ('0', '-3', 'x', ''):
+        with pytest.raises(ValueError) as e:
+            asm.Assembler('.code\n.repeat {0}\nNOP\n.endr\n'.format(count))
+        assert 'line 1: .repeat needs a count' in str(e.value)
+
+
+def test_repeat():
+    source = """\
+    .flags optimized
+    .locals x
+    .code
+      LOAD_CONST   0
+      STORE_FAST   x
+      .repeat 3
+    top:
+        LOAD_FAST    x
+        POP_JUMP_IF_TRUE top
+      .endr
+      .repeat 2
+        .repeat 2
+          NOP
+        .endr
+      .endr
+      LOAD_CONST   0
+      RETURN_VALUE
+    """
+    machine = asm.Assembler(source)
+    co = machine.assemble()
+
+    assert co.co_code == (
+        b'd\x00}\x00'
+        b'|\x00s\x04' b'|\x00s\x08' b'|\x00s\x0c'
+        + b'\t\x00' * 4 +
+        b'd\x00S\x00'
+    )
+    # lines go back for each copy
+    starts = [line for _, line in findlinestarts(co)]
+    assert starts == [4, 5, 8, 9, 8, 9, 8, 9, 13, 16, 17]
+
+
+def test_repeat_local_named_like_label():
+    source = """\
+    .flags optimized
+    .locals i
+    .code
+      LOAD_CONST   0
+      STORE_FAST   i
+      .repeat 2
+    i:
+        LOAD_FAST    i
+        POP_JUMP_IF_TRUE i
+      .endr
+      LOAD_FAST    i
+      RETURN_VALUE
+    """
+    co = asm.Assembler(source).assemble()
+
+    assert co.co_varnames == ('i',)
+    assert co.co_code == (
+        b'd\x00}\x00' b'|\x00s\x04' b'|\x00s\x08' b'|\x00S\x00'
+    )
+
+
+def test_repeat_long():
+    source = '.code\n.repeat 70000\nNOP\n.endr\nLOAD_CONST 0\nRETURN_VALUE'
+    machine = asm.Assembler(source)
+    co = machine.assemble()
+
+    assert len(machine.src) == 1
+    assert co.co_code == b'\t\x00' * 70000 + b'd\x00S\x00'
+
+
+def test_bind_directive():
+    source = """\
+    .bind range, len
+    .names len, range, missing
+    .code
+      LOAD_GLOBAL  len
+      LOAD_GLOBAL  range
+      LOAD_GLOBAL  missing
+      RETURN_VALUE
+    """
+    machine = asm.Assembler(source)
+    co = machine.assemble()
+
+    assert machine.bound == {'len': len, 'range': range}
+    assert co.co_consts == (None, len, range)
+    assert co.co_names == ('missing',)
+    assert co.co_code == b'd\x01d\x02t\x00S\x00'
+
+
+def test_bind_all():
+    source = '.bind\n.names len, missing\n.code\nLOAD_GLOBAL 0\nLOAD_GLOBAL 1'
+    machine = asm.Assembler(source, namespace={'len': 'shadowed'})
+    co = machine.assemble()
+
+    assert co.co_consts == (None, 'shadowed')
+    assert co.co_names == ('missing',)
+    assert co.co_code == b'd\x01t\x00'
+
+    with pytest.raises(NameError):
+        asm.Assembler('.bind missing\n.code\nNOP').assemble()
+
+
+SCALE = 3
+
+
+def test_bind_globals_decorator(monkeypatch):
+    def scale(x):
+        """
+        :::asm
+        .names SCALE, range
+        .code
+          LOAD_GLOBAL  SCALE
+          LOAD_FAST    x
+          BINARY_MULTIPLY
+          RETURN_VALUE
+        """
+    scale = asm.asm(bind_globals=True)(scale)
+
+    assert scale(2) == 6
+    assert scale.__code__.co_names == ('range',)
+    asm.check_bound_globals(__name__)
+
+    monkeypatch.setitem(globals(), 'SCALE', 4)
+    assert scale(2) == 6
+    with pytest.raises(RuntimeError) as e:
+        asm.check_bound_globals(sys.modules[__name__])
+    assert 'scale: SCALE' in str(e.value)
+
+    # the registry doesn't keep functions alive
+    code = scale.__code__
+    assert asm._has_bound_globals(code)
+    count = len(asm._BOUND)
+    del scale, code
+    assert len(asm._BOUND) == count - 1
+
+
+def test_bind_globals_equal_code(monkeypatch):
+    first = asm.asm(bind_globals=True)(_scale_template())
+    second = asm.asm(bind_globals=True)(_scale_template())
+    assert first.__code__ == second.__code__
+    del first
+
+    # the survivor is still checked
+    assert asm._has_bound_globals(second.__code__)
+    monkeypatch.setitem(globals(), 'SCALE', 4)
+    with pytest.raises(RuntimeError) as e:
+        asm.check_bound_globals(__name__)
+    assert '_scale_template.<locals>.scale: SCALE' in str(e.value)
+
+
+def _scale_template():
+    def scale(x):
+        """
+        :::asm
+        .names SCALE
+        .code
+          LOAD_GLOBAL  SCALE
+          LOAD_FAST    x
+          BINARY_MULTIPLY
+          RETURN_VALUE
+        """
+    return scale
+
+
+def test_unroll():
+    def fib(n):
+        """
+        :::asm
+        .locals a, b, idx
+        .names range
+        .consts
+          int0 = 0
+          int1 = 1
+        .code
+          LOAD_CONST               int0
+          STORE_FAST               a
+          LOAD_CONST               int1
+          STORE_FAST               b
+          SETUP_LOOP               after_loop
+          LOAD_GLOBAL              range
+          LOAD_FAST                n
+          CALL_FUNCTION            1
+          GET_ITER
+        .unroll 3
+        start_loop:
+          FOR_ITER                 end_loop
+          STORE_FAST               idx
+          LOAD_FAST                b
+          LOAD_FAST                a
+          LOAD_FAST                b
+          BINARY_ADD
+          ROT_TWO
+          STORE_FAST               a
+          STORE_FAST               b
+          JUMP_ABSOLUTE            start_loop
+        end_loop:
+          POP_BLOCK
+        after_loop:
+          LOAD_FAST                a
+          RETURN_VALUE
+        """
+    fib = asm.asm(fib)
+
+    assert [fib(n) for n in range(8)] == [0, 1, 1, 2, 3, 5, 8, 13]
+    code = fib.__code__.co_code
+    assert code.count(bytes([dis.opmap['FOR_ITER']])) == 3
+    assert code.count(bytes([dis.opmap['JUMP_ABSOLUTE'], 18])) == 1
+    # each copy is on the lines of the loop
+    starts = [line for _, line in findlinestarts(fib.__code__)]
+    loop = list(range(starts[9], starts[9] + 9))
+    last = loop[-1]
+    assert starts[9:] == loop * 3 + [last + 1, last + 3, last + 5, last + 6]
+
+
+def test_unroll_local_labels():
+    source = """\
+    .locals x
+    .code
+      LOAD_CONST    0
+      GET_ITER
+    .unroll 2
+    top:
+      FOR_ITER      done
+      POP_JUMP_IF_TRUE skip
+      JUMP_ABSOLUTE top
+    skip:
+      JUMP_ABSOLUTE top
+    done:
+      LOAD_CONST    0
+      RETURN_VALUE
+    """
+    machine = asm.Assembler(source)
+    co = machine.assemble()
+
+    assert co.co_code == (
+        b'd\x00D\x00'
+        b']\x0cs\x0aq\x04'
+        b']\x06s\x10q\x04'
+        b'q\x04'
+        b'd\x00S\x00'
+    )
+
+
+def test_unroll_errors():
+    with pytest.raises(ValueError) as e:
+        asm.Assembler('.code\n.unroll 2\nloop:\nNOP').assemble()
+    assert 'line 1: .unroll needs loop on a FOR_ITER' in str(e.value)
+    with pytest.raises(ValueError) as e:
+        asm.Assembler(
+            '.code\n.unroll 2\nloop:\nFOR_ITER end\nNOP\nend:\n'
+        ).assemble()
+    assert 'to end with JUMP_ABSOLUTE loop' in str(e.value)
+    with pytest.raises(ValueError):
+        asm.Assembler('.code\n.unroll\nloop:\nNOP')
+    with pytest.raises(ValueError):
+        asm.Assembler('.code\nNOP\n.unroll 2').assemble()
+    # a numeric jump past the loop would not follow the code it jumps to
+    with pytest.raises(ValueError) as e:
+        asm.Assembler(
+            '.code\nJUMP_FORWARD 6\n.unroll 2\nloop:\nFOR_ITER end\n'
+            'POP_TOP\nJUMP_ABSOLUTE loop\nend:\nLOAD_CONST 0\n'
+            'RETURN_VALUE\n'
+        ).assemble()
+    assert 'line 1: jumps in code with .unroll need labels' in str(e.value)
+
+
+STRIDED_SUM = """\
+.params values
+.locals total, idx
+.consts
+  zero = 0
+  one = 1
+  start = 0
+.code
+  LOAD_CONST     zero
+  STORE_FAST     total
+  LOAD_CONST     stride
+  LOAD_CONST     one
+  COMPARE_OP     2
+  POP_JUMP_IF_TRUE sum
+  LOAD_FAST      values
+  LOAD_CONST     start
+  LOAD_CONST     size
+  LOAD_CONST     stride
+  BUILD_SLICE    3
+  BINARY_SUBSCR
+  STORE_FAST     values
+sum:
+  SETUP_LOOP     done
+  LOAD_FAST      values
+  GET_ITER
+loop:
+  FOR_ITER       end
+  LOAD_FAST      total
+  BINARY_ADD
+  STORE_FAST     total
+  JUMP_ABSOLUTE  loop
+end:
+  POP_BLOCK
+done:
+  LOAD_FAST      total
+  RETURN_VALUE
+"""
+
+
+def test_specialize():
+    asm.SPECIALIZE_CACHE.clear()
+    strided = asm.specialize(STRIDED_SUM, size=6, stride=2)
+    plain = asm.specialize(STRIDED_SUM, size=6, stride=1)
+
+    assert asm.specialize(STRIDED_SUM, stride=2, size=6) is strided
+    assert asm.SPECIALIZE_CACHE.info().hits == 1
+    assert asm.SPECIALIZE_CACHE.info().currsize == 2
+
+    values = list(range(10))
+    func = types.FunctionType(strided, {})
+    assert func(values) == 0 + 2 + 4
+    func = types.FunctionType(plain, {})
+    assert func(values) == 45
+    # the slicing branch is gone
+    assert 'BUILD_SLICE' not in asm.dis(plain)
+    assert 'BUILD_SLICE' in asm.dis(strided)
+
+
+def test_specialize_function():
+    def scale(x):
+        """
+        Multiply by a factor
+        :::asm
+        .code
+          LOAD_FAST    x
+          LOAD_CONST   factor
+          BINARY_MULTIPLY
+          RETURN_VALUE
+        """
+    triple = asm.specialize(scale, factor=3)
+
+    assert triple(2) == 6
+    assert triple.__doc__ == '\n        Multiply by a factor\n        '
+    assert triple.__code__.co_consts[1] == 3
+    assert asm.specialize(scale, factor=[2])(2) == [2, 2]
+
+
+def test_compact_locals():
+    source = """\
+    .optimize 2
+    .params x
+    .locals t1, t2, unset, t3
+    .consts
+      one = 1
+    .code
+      LOAD_FAST    x
+      STORE_FAST   t1
+      LOAD_FAST    t1
+      LOAD_CONST   one
+      BINARY_ADD
+      STORE_FAST   t2
+      LOAD_FAST    t2
+      STORE_FAST   t3
+      LOAD_FAST    t3
+      LOAD_FAST    x
+      POP_JUMP_IF_TRUE done
+      LOAD_FAST    unset
+      RETURN_VALUE
+    done:
+      RETURN_VALUE
+    """
+    co = asm.Assembler(source).assemble()
+
+    # unset can be read before it is set, so it keeps its own slot
+    assert co.co_varnames == ('x', 't1', 'unset')
+    assert co.co_code[:16] == (
+        b'|\x00}\x01|\x01d\x01\x17\x00}\x01|\x01}\x01'
+    )
+    func = types.FunctionType(co, {})
+    assert func(1) == 2
+    with pytest.raises(UnboundLocalError):
+        func(0)
+
+
+def test_compact_locals_handler():
+    source = """\
+    .optimize 2
+    .params x
+    .locals a, b
+    .consts
+      one = 1
+    .code
+      LOAD_FAST    x
+      STORE_FAST   a
+      SETUP_EXCEPT handler
+      LOAD_FAST    x
+      LOAD_CONST   one
+      BINARY_SUBTRACT
+      STORE_FAST   b
+      LOAD_CONST   one
+      LOAD_FAST    b
+      BINARY_TRUE_DIVIDE
+      RETURN_VALUE
+    handler:
+      POP_TOP
+      POP_TOP
+      POP_TOP
+      POP_EXCEPT
+      LOAD_FAST    a
+      RETURN_VALUE
+    """
+    co = asm.Assembler(source).assemble()
+    func = types.FunctionType(co, {})
+
+    assert co.co_varnames == ('x', 'a', 'b')
+    assert func(3) == 0.5
+    assert func(1) == 1
+
+
+def test_dead_stores():
+    source = """\
+    .optimize 2
+    .params x
+    .locals dead, unused, kept
+    .names len, unused
+    .consts
+      one = 1
+      two = 2
+      spare = 3
+    .code
+      LOAD_CONST   spare
+      STORE_FAST   dead
+      LOAD_FAST    x
+      LOAD_CONST   one
+      BINARY_ADD
+      STORE_FAST   dead
+      LOAD_FAST    x
+      STORE_FAST   kept
+      LOAD_FAST    kept
+      STORE_FAST   dead
+      LOAD_GLOBAL  len
+      RETURN_VALUE
+    """
+    co = asm.Assembler(source).assemble()
+
+    assert co.co_code == b'|\x00d\x01\x17\x00\x01\x00t\x00S\x00'
+    assert co.co_consts == (None, 1)
+    assert co.co_names == ('len',)
+    assert co.co_varnames == ('x',)
+    assert co.co_nlocals == 1
+
+
+def test_dead_stores_kept():
+    source = """\
+    .optimize 2
+    .locals a, b
+    .code
+      LOAD_FAST    a
+      STORE_FAST   b
+      SETUP_EXCEPT handler
+      LOAD_CONST   0
+      STORE_FAST   b
+      LOAD_CONST   0
+      RETURN_VALUE
+    handler:
+      POP_TOP
+      POP_TOP
+      POP_TOP
+      LOAD_FAST    b
+      RETURN_VALUE
+    """
+    co = asm.Assembler(source).assemble()
+
+    # b is read by the handler, so both stores stay
+    assert co.co_code[:4] == b'|\x00}\x01'
+    assert co.co_code.count(b'}\x01') == 2
+
+
+def test_layout_cold_raise():
+    def check(x):
+        """
+        :::asm
+        .names ValueError
+        .code
+          LOAD_FAST            x
+          POP_JUMP_IF_TRUE     ok
+          LOAD_GLOBAL          ValueError
+          RAISE_VARARGS        1
+        ok:
+          LOAD_FAST            x
+          RETURN_VALUE
+        """
+    laid_out = asm.asm(optimize=2)(check)
+    plain = asm.asm(optimize=1)(check)
+
+    assert laid_out.__code__.co_code == (
+        b'|\x00r\x08|\x00S\x00t\x00\x82\x01'
+    )
+    assert laid_out(5) == 5
+    # the raise keeps its line
+    lines = []
+    for func in (plain, laid_out):
+        with pytest.raises(ValueError) as e:
+            func(0)
+        lines.append(traceback.extract_tb(e.tb)[-1].lineno)
+    assert lines[0] == lines[1]
+
+
+def test_layout_added_jump():
+    source = """\
+    .optimize 2
+    .params items
+    .names ValueError
+    .code
+      LOAD_FAST            items
+      GET_ITER
+      FOR_ITER             done
+      POP_TOP
+      LOAD_GLOBAL          ValueError
+      RAISE_VARARGS        1
+    done:
+      LOAD_CONST           0
+      RETURN_VALUE
+    """
+    co = asm.Assembler(source).assemble()
+    func = types.FunctionType(co, {'ValueError': ValueError})
+
+    # FOR_ITER can't be inverted, so it is followed by a jump to the body
+    assert co.co_code == (
+        b'|\x00D\x00]\x02q\x0cd\x00S\x00\x01\x00t\x00\x82\x01'
+    )
+    # the jump at offset 6 belongs to the line of the FOR_ITER, not to
+    # the done block after it
+    assert list(findlinestarts(co)) == [
+        (0, 5), (2, 6), (4, 7), (8, 12), (10, 13), (12, 8), (14, 9), (16, 10)
+    ]
+    assert func([]) is None
+    with pytest.raises(ValueError):
+        func([1])
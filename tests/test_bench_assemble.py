@@ -0,0 +1,57 @@
+"""
+Smoke test of the assembler benchmarks
+"""
+import importlib.util
+import json
+import os
+
+
+BENCHMARKS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'
+)
+
+
+def _load_bench():
+    spec = importlib.util.spec_from_file_location(
+        'bench_assemble', os.path.join(BENCHMARKS, 'bench_assemble.py')
+    )
+    bench = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bench)
+    return bench
+
+
+def test_bench_assemble(tmp_path, capsys):
+    bench = _load_bench()
+    output = str(tmp_path / 'run.json')
+
+    assert bench.main(['--sizes', '10', '-r', '1', '-o', output, '-b']) == 0
+
+    with open(output) as fp:
+        current = json.load(fp)
+    assert set(current['results']) == {
+        'synthetic-10', 'fib_inner', 'metafib', 'bad'
+    }
+    result = current['results']['synthetic-10']
+    assert result['instructions'] == 10
+    assert set(result['phases']) == set(bench.PHASES)
+    assert 'synthetic-10' in capsys.readouterr().out
+
+    # the stored baseline covers every case
+    with open(bench.BASELINE) as fp:
+        baseline = json.load(fp)
+    assert set(current['results']) <= set(baseline['results'])
+
+
+def test_bench_compare():
+    bench = _load_bench()
+
+    def run(seconds):
+        return {'results': {'case': {'phases': dict.fromkeys(
+            bench.PHASES, seconds
+        )}}}
+
+    assert bench.compare(run(0.011), run(0.01), 0.2, out=None) == []
+    slower = bench.compare(run(0.013), run(0.01), 0.2, out=None)
+    assert [phase for _, phase, _ in slower] == list(bench.PHASES)
+    # too short to compare
+    assert bench.compare(run(0.0003), run(0.0001), 0.2, out=None) == []
@@ -0,0 +1,226 @@
+"""
+Ahead of time builds of asm modules
+"""
+import os
+import shutil
+import sys
+
+import cpython_assembly.asm as asm
+from cpython_assembly import build
+from cpython_assembly.__main__ import main
+
+
+ASSETS = os.path.join(os.path.dirname(__file__), 'assets')
+
+
+def _make_package(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+    monkeypatch.setattr(sys, 'modules', dict(sys.modules))
+    package = tmp_path / 'aotpkg'
+    package.mkdir()
+    (package / '__init__.py').write_text('')
+    (package / 'plain.py').write_text('def f():\n    pass\n')
+    for name in ('metafib.py', 'longbad.py'):
+        shutil.copy(os.path.join(ASSETS, name), str(package / name))
+    return package
+
+
+def test_build(tmp_path, monkeypatch):
+    package = _make_package(tmp_path, monkeypatch)
+
+    results = build.build([str(tmp_path)], max_workers=1)
+
+    assert [(os.path.basename(path), n) for path, n in results] == [
+        ('longbad.py', 1), ('metafib.py', 2)
+    ]
+    assert build.build([str(package / 'metafib.py')]) == [
+        (str(package / 'metafib.py'), None)
+    ]
+
+    def broken(self):
+        raise AssertionError('should have been prebuilt')
+
+    monkeypatch.setattr(asm.Assembler, 'assemble', broken)
+    for name in ('aotpkg', 'aotpkg.metafib', 'aotpkg.longbad'):
+        del sys.modules[name]
+    from aotpkg.metafib import metafib
+    from aotpkg.longbad import bad
+
+    assert metafib(0, 1)(7) == 13
+    assert bad(10) == 13
+    assert bad.__doc__ == '\n    Test func\n    '
+
+
+def test_build_stale(tmp_path, monkeypatch):
+    package = _make_package(tmp_path, monkeypatch)
+    path = str(package / 'longbad.py')
+
+    assert build.build_file(path) == 1
+    # a .pyc for a different source mtime is stale
+    os.utime(path, (0, 0))
+    assert build.build_file(path) == 1
+    assert build.build_file(path) is None
+    assert build.build_file(path, force=True) == 1
+
+
+def test_build_cli(tmp_path, monkeypatch, capsys):
+    package = _make_package(tmp_path, monkeypatch)
+
+    assert main(['build', '-j', '1', str(package / 'longbad.py')]) == 0
+    assert main(['build', str(package / 'longbad.py')]) == 0
+
+    out = capsys.readouterr().out.splitlines()
+    assert out[0].endswith('longbad.py: 1 functions prebuilt')
+    assert out[1].endswith('longbad.py: up to date')
+
+
+BOUND_MODULE = '''\
+from cpython_assembly import asm
+
+
+@asm.asm
+def count(n):
+    """
+    :::asm
+    .bind len, range
+    .names len, range
+    .code
+      LOAD_GLOBAL    len
+      LOAD_GLOBAL    range
+      LOAD_FAST      n
+      CALL_FUNCTION  1
+      CALL_FUNCTION  1
+      RETURN_VALUE
+    """
+
+
+@asm.asm
+def negate(x):
+    """
+    :::asm
+    .code
+      LOAD_FAST          x
+      UNARY_NEGATIVE
+      RETURN_VALUE
+    """
+'''
+
+
+def test_build_bound_globals(tmp_path, monkeypatch):
+    package = _make_package(tmp_path, monkeypatch)
+    path = package / 'bound.py'
+    path.write_text(BOUND_MODULE)
+
+    assert build.build_file(str(path)) == 1
+
+    del sys.modules['aotpkg.bound']
+    assemble = asm.Assembler.assemble
+    assembled = []
+
+    def counting(self):
+        assembled.append(self)
+        return assemble(self)
+
+    monkeypatch.setattr(asm.Assembler, 'assemble', counting)
+    from aotpkg.bound import count, negate
+
+    assert count(4) == 4
+    assert negate(4) == -4
+    assert [machine.bound for machine in assembled] == [
+        {'len': len, 'range': range}
+    ]
+
+
+QUALNAME_MODULE = '''\
+from cpython_assembly import asm
+
+
+class Calc:
+    @asm.asm
+    def neg(x):
+        """
+        :::asm
+        .code
+          LOAD_FAST          x
+          UNARY_NEGATIVE
+          RETURN_VALUE
+        """
+
+
+@asm.asm
+def twice(x):
+    """
+    :::asm
+    .code
+      LOAD_FAST          x
+      LOAD_FAST          x
+      BINARY_ADD
+      RETURN_VALUE
+    """
+
+
+first_twice = twice
+
+
+@asm.asm
+def twice(x):
+    """
+    :::asm
+    .consts
+      two = 2
+    .code
+      LOAD_FAST          x
+      LOAD_CONST         two
+      BINARY_MULTIPLY
+      RETURN_VALUE
+    """
+'''
+
+
+def test_build_qualnames(tmp_path, monkeypatch):
+    package = _make_package(tmp_path, monkeypatch)
+    path = package / 'calc.py'
+    path.write_text(QUALNAME_MODULE)
+
+    # twice is defined twice, so it is left to be assembled on import
+    assert build.build_file(str(path)) == 1
+
+    del sys.modules['aotpkg.calc']
+    assemble = asm.Assembler.assemble
+    assembled = []
+
+    def counting(self):
+        assembled.append(self)
+        return assemble(self)
+
+    monkeypatch.setattr(asm.Assembler, 'assemble', counting)
+    from aotpkg.calc import Calc, first_twice, twice
+
+    assert Calc.neg(3) == -3
+    assert first_twice('a') == 'aa'
+    assert twice('a') == 'aa'
+    assert len(assembled) == 2
+
+
+def test_build_stale_assembler(tmp_path, monkeypatch):
+    package = _make_package(tmp_path, monkeypatch)
+    path = str(package / 'longbad.py')
+
+    assert build.build_file(path) == 1
+    assert build.build_file(path) is None
+
+    # a .pyc prebuilt by another version of the assembler is stale, and
+    # is not what the module is imported from to rebuild it
+    monkeypatch.setattr(asm, '_ASSEMBLER_DIGEST', b'\1' * 32)
+    del sys.modules['aotpkg.longbad']
+    assemble = asm.Assembler.assemble
+    assembled = []
+
+    def counting(self):
+        assembled.append(self)
+        return assemble(self)
+
+    monkeypatch.setattr(asm.Assembler, 'assemble', counting)
+    assert build.build_file(path) == 1
+    assert len(assembled) == 1
+    assert build.build_file(path) is None
@@ -0,0 +1,92 @@
+"""
+Bulk disassembly of packages
+"""
+import os
+import sys
+
+from cpython_assembly import disassemble
+from cpython_assembly.__main__ import main
+
+
+MODULE = '''\
+def outer(x):
+    def inner(y):
+        return x + y
+    return inner
+
+
+class Thing:
+    def method(self):
+        return [i for i in range(3)]
+'''
+
+
+def _make_package(tmp_path):
+    package = tmp_path / 'dispkg'
+    package.mkdir()
+    (package / '__init__.py').write_text('')
+    (package / 'mod.py').write_text(MODULE)
+    (package / 'broken.py').write_text('def f(:\n')
+    return package
+
+
+def test_disassemble(tmp_path):
+    package = _make_package(tmp_path)
+    output = tmp_path / 'out'
+
+    results = dict(disassemble.disassemble(
+        [str(package)], str(output), max_workers=2
+    ))
+
+    assert isinstance(results[str(package / 'broken.py')], SyntaxError)
+    assert results[str(package / '__init__.py')] == [('<module>', 1, 2)]
+    summary = results[str(package / 'mod.py')]
+    assert [qualname for qualname, _, _ in summary] == [
+        '<module>', 'outer', 'outer.<locals>.inner', 'Thing',
+        'Thing.method', 'Thing.method.<locals>.<listcomp>'
+    ]
+    assert summary[2] == ('outer.<locals>.inner', 2, 4)
+
+    assert sorted(os.listdir(str(output))) == [
+        'dispkg.asm', 'dispkg.mod.asm', 'index.txt'
+    ]
+    index = (output / 'index.txt').read_text().splitlines()
+    assert '         4  dispkg.mod:outer.<locals>.inner  line 2' in index
+    assert len(index) == 7
+
+    listing = (output / 'dispkg.mod.asm').read_text()
+    assert '; dispkg.mod:Thing.method  line 8\n.function Thing_method\n' in (
+        listing
+    )
+    assert '    .params self\n' in listing
+
+
+def test_disassemble_listing_assembles(tmp_path):
+    package = _make_package(tmp_path)
+    output = tmp_path / 'out'
+    disassemble.disassemble([str(package / 'mod.py')], str(output))
+
+    from cpython_assembly import importer
+    sections = (output / 'dispkg.mod.asm').read_text().split('\n\n')
+    section = [s for s in sections if ':outer.<locals>.inner ' in s][0]
+    code = importer.compile_module(section)
+    inner = [c for c in code.co_consts if hasattr(c, 'co_code')][0]
+
+    expected = compile(MODULE, 'mod', 'exec').co_consts[0].co_consts[1]
+    assert inner.co_name == 'outer__locals__inner'
+    assert inner.co_code == expected.co_code
+    assert inner.co_varnames == expected.co_varnames
+    assert inner.co_freevars == expected.co_freevars
+
+
+def test_disassemble_cli(tmp_path, monkeypatch, capsys):
+    package = _make_package(tmp_path)
+    monkeypatch.setattr(sys, 'path', [str(tmp_path)] + sys.path)
+    output = tmp_path / 'out'
+
+    assert main(['dis', '-j', '1', '-o', str(output), 'dispkg.mod']) == 0
+    assert main(['dis', '-o', str(output), str(package)]) == 1
+
+    captured = capsys.readouterr()
+    assert captured.out.splitlines()[0].endswith('mod.py: 6 code objects')
+    assert 'broken.py: SyntaxError' in captured.err
@@ -0,0 +1,108 @@
+"""
+Importing standalone .asm modules
+"""
+import os
+import sys
+import traceback
+
+import pytest
+
+import cpython_assembly.asm as asm
+from cpython_assembly import importer
+
+
+ASM_MODULE = """\
+; a module written in assembly
+
+.function add
+.params a, b
+.code
+  LOAD_FAST      a
+  LOAD_FAST      b
+  BINARY_ADD
+  RETURN_VALUE
+
+.function bad
+.params x
+.names ValueError
+.code
+  LOAD_GLOBAL    ValueError
+  CALL_FUNCTION  0
+  RAISE_VARARGS  1
+"""
+
+
+@pytest.fixture
+def asm_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, 'path', [str(tmp_path)] + sys.path)
+    monkeypatch.setattr(sys, 'modules', dict(sys.modules))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', False)
+    importer.install()
+    yield tmp_path
+    importer.uninstall()
+
+
+def test_import(asm_path):
+    (asm_path / 'asmmod.asm').write_text(ASM_MODULE)
+    import asmmod
+
+    assert asmmod.add(2, 3) == 5
+    assert asmmod.add.__code__.co_firstlineno == 3
+    try:
+        asmmod.bad(1)
+    except ValueError:
+        frame, lno = list(traceback.walk_tb(sys.exc_info()[2]))[-1]
+    assert frame.f_code.co_filename == str(asm_path / 'asmmod.asm')
+    assert lno == 17
+
+
+def test_import_cached(asm_path, monkeypatch):
+    (asm_path / 'asmmod.asm').write_text(ASM_MODULE)
+    import asmmod
+    assert os.listdir(str(asm_path / '__pycache__')) == [
+        'asmmod.{0}.pyc'.format(sys.implementation.cache_tag)
+    ]
+
+    def broken(self):
+        raise AssertionError('should have been cached')
+
+    monkeypatch.setattr(asm.Assembler, 'assemble', broken)
+    del sys.modules['asmmod']
+    import asmmod
+    assert asmmod.add(2, 3) == 5
+
+
+def test_import_stale_assembler(asm_path, monkeypatch):
+    (asm_path / 'asmmod.asm').write_text(ASM_MODULE)
+    import asmmod
+
+    assemble = asm.Assembler.assemble
+    assembled = []
+
+    def counting(self):
+        assembled.append(self)
+        return assemble(self)
+
+    monkeypatch.setattr(asm.Assembler, 'assemble', counting)
+    monkeypatch.setattr(asm, '_ASSEMBLER_DIGEST', b'\1' * 32)
+    del sys.modules['asmmod']
+    import asmmod
+
+    # bytecode from another version of the assembler isn't used
+    assert asmmod.add(2, 3) == 5
+    assert assembled
+
+
+def test_import_py_first(asm_path):
+    (asm_path / 'asmmod.asm').write_text(ASM_MODULE)
+    (asm_path / 'asmmod.py').write_text('add = None\n')
+    import asmmod
+    assert asmmod.add is None
+
+
+def test_compile_module_errors():
+    with pytest.raises(SyntaxError) as e:
+        importer.compile_module('.names x\n.function f\n.code\nRETURN_VALUE')
+    assert e.value.lineno == 1
+    with pytest.raises(SyntaxError):
+        importer.compile_module('.function\n.code\nRETURN_VALUE')
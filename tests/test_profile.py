@@ -0,0 +1,127 @@
+"""
+Instruction level profiling of assembled functions
+"""
+import io
+
+from cpython_assembly.asm import asm
+from cpython_assembly.profile import Profile
+
+
+@asm
+def fib(n):
+    """
+    Return the nth fibonacci number
+    :::asm
+    .stacksize 4
+    .flags optimized, newlocals, nofree
+    .locals a, b, idx
+    .names range
+    .consts
+      int0 = 0
+      int1 = 1
+    .code
+      LOAD_CONST               int0
+      STORE_FAST               a
+      LOAD_CONST               int1
+      STORE_FAST               b
+      SETUP_LOOP               after_loop
+      LOAD_GLOBAL              range
+      LOAD_FAST                n
+      CALL_FUNCTION            1
+      GET_ITER
+    start_loop:
+      FOR_ITER                 end_loop
+      STORE_FAST               idx
+      LOAD_FAST                b
+      LOAD_FAST                a
+      LOAD_FAST                b
+      BINARY_ADD
+      ROT_TWO
+      STORE_FAST               a
+      STORE_FAST               b
+      JUMP_ABSOLUTE            start_loop
+    end_loop:
+      POP_BLOCK
+    after_loop:
+      LOAD_FAST                a
+      RETURN_VALUE
+    """
+
+
+# lines of the test file
+FOR_ITER_LINE = 33
+RETURN_LINE = 47
+
+
+def test_profile_counts():
+    with Profile(fib) as prof:
+        assert fib(10) == 55
+        assert fib(5) == 5
+
+    counts = prof.counts(fib)
+    # FOR_ITER at offset 18 runs once more than the loop body
+    assert counts[18][0] == 17
+    assert counts[20][0] == 15
+    assert counts[0][0] == 2
+    assert all(seconds >= 0 for _, seconds in counts.values())
+
+    lines = prof.line_stats(fib)
+    assert lines[FOR_ITER_LINE][0] == 17
+    assert lines[RETURN_LINE][0] == 2
+
+
+def test_profile_untraced():
+    prof = Profile(fib)
+    fib(3)
+    with prof:
+        pass
+    assert prof.counts(fib) == {}
+
+
+def test_profile_report():
+    with Profile(fib) as prof:
+        fib(10)
+
+    out = io.StringIO()
+    prof.report(fib, file=out)
+    lines = out.getvalue().splitlines()
+
+    assert lines[0].startswith('    ; profile: ')
+    for_iter = [line for line in lines if 'FOR_ITER' in line][0]
+    assert for_iter.startswith('      FOR_ITER')
+    assert '         11 ' in for_iter
+    assert for_iter.endswith('line {0}'.format(FOR_ITER_LINE))
+
+
+def _pick(x):
+    """
+    :::asm
+    .consts
+      zero = 0
+    .code
+      LOAD_FAST            x
+      POP_JUMP_IF_TRUE     big
+      LOAD_CONST           zero
+      RETURN_VALUE
+    big:
+      LOAD_FAST            x
+      RETURN_VALUE
+    """
+
+
+def test_profile_layout(tmpdir):
+    pick = asm(_pick)
+    with Profile(pick) as prof:
+        for x in range(1, 200):
+            pick(x)
+    path = str(tmpdir.join('pick.json'))
+    with open(path, 'w') as fp:
+        prof.dump(pick, fp)
+
+    laid_out = asm(layout_profile=path)(_pick)
+
+    # the branch never taken is moved to the end
+    assert pick.__code__.co_code == b'|\x00s\x08d\x01S\x00|\x00S\x00'
+    assert laid_out.__code__.co_code == b'|\x00r\x08|\x00S\x00d\x01S\x00'
+    assert laid_out(0) == 0
+    assert laid_out(3) == 3